@@ -8,10 +8,10 @@ Purpose: UI for aki-reporter package
 
 Functions:
 
-    make_maindashtable(df : pd.DataFrame)->dash_table.DataTable:
+    make_maindashtable(main_table : datatable_query.PreparedTable)->dash_table.DataTable:
         '''Returns main dashtable of new aki samples'''
 
-    make_scatterplot(specimen_table : pd.DataFrame,slct_row_name:list[str])->dcc.Graph:
+    make_scatterplot(specimen_table : pd.DataFrame,colors,max_points : int=SCATTER_MAX_POINTS)->dcc.Graph:
         '''Returns graph of Cr vs time for selected MRN'''
 
     make_specdashtable(specimen_table : pd.DataFrame)->dash_table.DataTable:
@@ -20,6 +20,15 @@ Functions:
     update_elements(slctd_mrn):
         '''Returns updated app elements based on user selections'''
 
+    keep_selection(page_selected_ids,data,selected_ids):
+        '''Returns the ids selected anywhere in a table after a check or uncheck on its current page'''
+
+    check_live(n_intervals,seen):
+        '''Signals the tables to refresh when the live feed has staged new results'''
+
+    serve_layout():
+        '''Returns page layout for the current data snapshot, evaluated on each page load'''
+
 """
 
 
@@ -29,7 +38,6 @@ import dash
 import dash_bootstrap_components as dbc
 from dash import ctx, dash_table , html, dcc
 from dash.dependencies import Input, Output, State
-import plotly.express as px
 import plotly.graph_objects as go
 import pandas as pd
 import pickle
@@ -37,6 +45,20 @@ from datetime import datetime,timedelta
 import dash_auth
 import queries
 import aki_analysis
+import encounter_index
+import refresher
+import live
+import shared_data
+import snapshots
+import datatable_query
+import inventory_store
+import outpatient_store
+import metrics
+import flask
+from contextlib import closing
+import os
+import logging
+import time
 import numpy as np
 
 
@@ -46,14 +68,73 @@ import numpy as np
 VALID_USERNAME_PASSWORD_PAIRS=dict(pd.read_csv('users.txt',header=None).values)
 
 #%% Import data
-df=queries.main()
-df=aki_analysis.main(df)
+COLD_START=os.environ.get('AKI_COLD_START','snapshot') # 'snapshot': serve last analyzed snapshot while the first refresh runs, 'query': wait for it
+
+LOCAL_OUTPATIENT='AKI_OUTPATIENT_DB' in os.environ # outpatient baselines from the local store (outpatient_store.py) rather than the query
+
+def load_outpatient_history(raw: pd.DataFrame,update: bool=False)->pd.DataFrame:
+    '''Returns stored outpatient results of the patients in raw, fetching new ones first if update'''
+    with closing(outpatient_store.connect()) as conn:
+        if update:
+            outpatient_store.update(conn,queries.main_outpatient)
+        return(outpatient_store.load_history(conn,raw['EPIC_MRN'].dropna().unique()))
+
+def load_data()->pd.DataFrame:
+    '''Returns freshly queried and analyzed data, persisted for the next cold start'''
+    raw=queries.main()
+    history=load_outpatient_history(raw,update=True) if LOCAL_OUTPATIENT else None
+    df=aki_analysis.main(raw,outpatient_history=history)
+    with metrics.stage('write_snapshot',len(df)):
+        snapshots.write_snapshot(df,'analyzed')
+    return(df)
+
+SHARED_DATA=shared_data.SHARED_ROOT is not None # AKI_SHARED_DATA: one worker process publishes, every worker maps it read-only
+
+if SHARED_DATA:
+    data_refresher=refresher.Refresher(shared_data.SharedLoader(load_data),interval_minutes=shared_data.CHECK_SECONDS/60) # checks the version stamp
+else:
+    data_refresher=refresher.Refresher(load_data) # rebuilt every AKI_REFRESH_MINUTES and swapped in without restarting
+specimen_cache=refresher.SnapshotCache() # (data version, MRNs) -> specimen table, its first page records and base figure
+table_cache=refresher.SnapshotCache(maxsize=4) # (data version, table name) -> display ready table
+data_refresher.listeners.append(specimen_cache.clear)
+data_refresher.listeners.append(table_cache.clear)
+live_feed=live.LiveFeed(outpatient_history=load_outpatient_history if LOCAL_OUTPATIENT else None,
+    interval_minutes=0 if SHARED_DATA else live.LIVE_MINUTES) # results performed since the snapshot, every AKI_LIVE_MINUTES; per process, so off with shared data
+data_refresher.listeners.append(live_feed.on_publish)
+LIVE_CHECK_SECONDS=30 # how often browsers ask whether the live feed has new rows
+MAIN_PAGE_SIZE=8
+SPEC_PAGE_SIZE=10
+INVENTORY_PAGE_SIZE=30
+SCATTER_MAX_POINTS=1000 # longer Cr series are thinned on the plot
+BASELINE_BANDS=[(1.0,'#0000ff'),(1.5,'#00FF00'),(2.0,'#FFA500'),(3.0,'#FF0000')] # multiples of the outpatient baseline drawn on the plot
+SCATTER_TEMPLATE=go.layout.Template(layout=dict(
+    font=dict(color='#2a3f5f'),
+    paper_bgcolor='white',
+    plot_bgcolor='#E5ECF6',
+    hovermode='closest',
+    margin=dict(l=20,r=20,t=30,b=30),
+    title=dict(x=0.05),
+    xaxis=dict(title=dict(text='Drawn DTTM',standoff=15),automargin=True,gridcolor='white',linecolor='white',zerolinecolor='white',zerolinewidth=2),
+    yaxis=dict(title=dict(text='Cr',standoff=15),automargin=True,gridcolor='white',linecolor='white',zerolinecolor='white',zerolinewidth=2),
+)) # built once; the plotly look without the defaults for every trace type that px sends with each figure
+last_df,last_written=snapshots.read_latest('analyzed') if COLD_START=='snapshot' and not SHARED_DATA else (None,None)
+if SHARED_DATA:
+    while data_refresher.refresh() is None: # until the publishing worker has written a first version
+        time.sleep(5)
+    data_refresher.start()
+elif last_df is not None:
+    data_refresher.publish(last_df,last_written)
+    data_refresher.start(refresh_now=True)
+else:
+    data_refresher.refresh()
+    data_refresher.start()
+live_feed.start()
 
 
 #%% Helper functions
 def make_maintable(df: pd.DataFrame)->pd.DataFrame:
     """Returns main table pandas dataframe"""
-    filt_maintable=((df['aki_sample']!=False)&(df['NEW_RESULT_IND']!=0))
+    filt_maintable=((df['aki_sample'].notna())&(df['NEW_RESULT_IND']!=0))
     cols_maintable={'NAME_FULL_FORMATTED':'NAME',
             'BIRTH_DT_TM':'DOB',
             'EPIC_MRN':'MRN',
@@ -76,7 +157,34 @@ def make_maintable(df: pd.DataFrame)->pd.DataFrame:
     main_table=main_table.drop_duplicates(subset=['MRN']).sort_values(by='MRN',ignore_index=True)
     return(main_table)
 
-def make_maindashtable(main_table : pd.DataFrame)->dash_table.DataTable:
+def make_live_maintable(snapshot : refresher.DataSnapshot,delta : live.LiveDelta)->datatable_query.PreparedTable:
+    '''Returns main table of the snapshot with the live feed's newer aki samples merged in, its records built and serialized'''
+    main_table=table_cache.get(snapshot,'main_table',lambda snapshot: make_maintable(snapshot.df))
+    if len(delta.df)>0:
+        main_table=pd.concat([make_maintable(delta.df),main_table],ignore_index=True) # only the delta is rebuilt
+        main_table=main_table.sort_values(by='Drawn DTTM',ascending=False,kind='stable').drop_duplicates(subset=['MRN'],keep='first')
+        main_table=main_table.sort_values(by='MRN',ignore_index=True)
+    return(datatable_query.prepare_table(main_table))
+
+def current_data()->tuple:
+    '''Returns the current snapshot, the live delta staged on top of it and a key naming both'''
+    snapshot=data_refresher.current()
+    delta=live_feed.delta()
+    if delta.version!=snapshot.version: # a refresh is being published, the delta belongs to the previous snapshot
+        delta=live.LiveDelta(snapshot.version,0,None,pd.DataFrame())
+    return(snapshot,delta,f'{snapshot.version}.{delta.seq}')
+
+def current_maintable()->tuple:
+    '''Returns the prepared main table for the current data and the key naming that data'''
+    snapshot,delta,key=current_data()
+    return(table_cache.get(snapshot,('main_table',delta.seq),lambda snapshot: make_live_maintable(snapshot,delta)),key)
+
+def prepare_maintable(snapshot : refresher.DataSnapshot):
+    '''Builds the main table of a newly published snapshot, so page loads find it ready'''
+    delta=live.LiveDelta(snapshot.version,0,None,pd.DataFrame())
+    table_cache.get(snapshot,('main_table',0),lambda snapshot: make_live_maintable(snapshot,delta))
+
+def make_maindashtable(main_table : datatable_query.PreparedTable)->dash_table.DataTable:
     """Returns main dashtable of new aki samples"""
     main_dashtable=dash_table.DataTable(
         id='main-dashtable',
@@ -154,107 +262,78 @@ def make_maindashtable(main_table : pd.DataFrame)->dash_table.DataTable:
                 'hideable':True,
             },        
         ],
-        data=main_table.to_dict('records'),  # the contents of the table
+        data=main_table.records[:MAIN_PAGE_SIZE],  # first page, later pages come from page_maindashtable
         hidden_columns=['NAME','DOB'],
         editable=True,              # allow editing of data inside all cells
-        filter_action="native",     # allow filtering of data by user ('native') or not ('none')
-        sort_action="native",       # enables data to be sorted per-column by user or not ('none')
+        filter_action="custom",     # filtering is done on the server by page_maindashtable
+        filter_query='',
+        sort_action="custom",       # sorting is done on the server by page_maindashtable
         sort_mode="single",         # sort across 'multi' or 'single' columns
         column_selectable="multi",  # allow users to select 'multi' or 'single' columns
         row_selectable="single",     # allow users to select 'multi' or 'single' rows
         row_deletable=False,         # choose if user can delete a row (True) or not (False)
         selected_columns=[],        # ids of columns that user selects
         selected_rows=[],           # indices of rows that user selects
-        page_action="native",       # all data is passed to the table up-front or not ('none')
+        sort_by=[],
+        page_action="custom",       # only the current page is sent to the browser
         page_current=0,             # page number that user is on
-        page_size=8,                # number of rows visible per page
+        page_size=MAIN_PAGE_SIZE,   # number of rows visible per page
+        page_count=max(1,-(-len(main_table.records)//MAIN_PAGE_SIZE)),
     )
     return(main_dashtable)
 
-def make_scatterplot(specimen_table : pd.DataFrame,colors)->dcc.Graph:
-    '''Returns graph of Cr vs time for selected MRN'''
+def downsample_series(specimen_table : pd.DataFrame,max_points : int=SCATTER_MAX_POINTS)->pd.DataFrame:
+    '''Returns about max_points rows of a time ordered specimen table, keeping every staged result and the lowest and highest Cr of each stretch'''
+    if max_points is None or len(specimen_table)<=max_points:
+        return(specimen_table)
+    staged=specimen_table['KDIGO'].notna().to_numpy()
+    cr=pd.to_numeric(specimen_table['Cr'],errors='coerce').to_numpy(dtype=float,na_value=np.nan)
+    n_buckets=max(1,(max_points-int(staged.sum()))//2)
+    stretch=np.arange(len(cr))*n_buckets//len(cr)
+    keep=staged.copy()
+    keep[pd.Series(np.where(np.isnan(cr),np.inf,cr)).groupby(stretch).idxmin().to_numpy()]=True # missing Cr are not plotted anyway
+    keep[pd.Series(np.where(np.isnan(cr),-np.inf,cr)).groupby(stretch).idxmax().to_numpy()]=True
+    return(specimen_table.loc[keep])
+
+def make_scatterplot(specimen_table : pd.DataFrame,colors,max_points : int=SCATTER_MAX_POINTS)->dcc.Graph:
+    '''Returns graph of Cr vs time for selected MRN, with series longer than max_points thinned (see downsample_series)'''
     outpatient_baseline=np.nan
     if len(specimen_table)>0:
         title=f'EPIC MRN = {specimen_table.MRN[0]}'
         outpatient_baseline=specimen_table['OP Base'][0]
     else: 
         title='EPIC MRN =          '
-    fig=px.scatter(
-        data_frame=specimen_table,
-        x='Drawn DTTM',
-        y='Cr',
-        hover_data=['Acc #'],
-        title=title
-    )
-    fig.update_layout(
-        margin=dict(l=20,r=20,t=30,b=30)
+    points=downsample_series(specimen_table,max_points)
+    if len(set(colors))==1:
+        colors=colors[0] # one color is validated and sent once rather than per point
+    elif len(colors)==len(specimen_table) and len(points)<len(specimen_table):
+        colors=pd.Series(colors,index=specimen_table.index).loc[points.index].tolist()
+    five_days_ago=datetime.now()-timedelta(days=5)
+    shapes=[dict(type='line',xref='x',x0=five_days_ago,x1=five_days_ago,yref='y domain',y0=0,y1=1,
+        line=dict(color='black',width=0.75,dash='dash'))]
+    if pd.notna(outpatient_baseline):
+        shapes+=[dict(type='line',xref='paper',x0=0,x1=1,yref='y',y0=multiple*outpatient_baseline,y1=multiple*outpatient_baseline,
+            line=dict(color=color,width=0.75),name=f'{multiple:.1f}x OP Base',showlegend=True)
+            for multiple,color in BASELINE_BANDS] # span the plot, so no date range is needed
+    fig=go.Figure(
+        data=[go.Scattergl(
+            x=points['Drawn DTTM'],
+            y=points['Cr'],
+            customdata=points[['Acc #']].to_numpy(), # read by the clientside recolor callback
+            hovertemplate='Drawn DTTM=%{x}<br>Cr=%{y}<br>Acc #=%{customdata[0]}<extra></extra>',
+            mode='markers',
+            marker=dict(color=colors,size=10),
+            showlegend=False,
+        )],
+        layout=go.Layout(template=SCATTER_TEMPLATE,title=dict(text=title),shapes=shapes),
     )
-    fig.update_traces(
-        marker_color=colors,
-        marker={'size':10}
-    )
-    fig.add_vline(
-        datetime.now()-timedelta(days=5),
-            line=dict(
-            color="black",
-            width=0.75,
-            dash="dash"
-        )
-    )
-    if not np.isnan(outpatient_baseline):
-        fig.add_trace(
-            go.Scatter(
-                x=[min(specimen_table['Drawn DTTM']),max(specimen_table['Drawn DTTM'])],
-                y=[outpatient_baseline,outpatient_baseline],
-                mode='lines',
-                name='1.0x OP Base',
-                line=dict(
-                    color="#0000ff",
-                    width=0.75,
-                )
-            )
-        ),
-        fig.add_trace(
-            go.Scatter(
-                x=[min(specimen_table['Drawn DTTM']),max(specimen_table['Drawn DTTM'])],
-                y=[1.5*outpatient_baseline,1.5*outpatient_baseline],
-                mode='lines',
-                name='1.5x OP Base',
-                line=dict(
-                    color="#00FF00",
-                    width=0.75,
-                )
-            )
-        ),
-        fig.add_trace(
-            go.Scatter(
-                x=[min(specimen_table['Drawn DTTM']),max(specimen_table['Drawn DTTM'])],
-                y=[2*outpatient_baseline,2*outpatient_baseline],
-                mode='lines',
-                name='2.0x OP Base',
-                line=dict(
-                    color="#FFA500",
-                    width=0.75,
-                )
-            )
-        ),
-        fig.add_trace(
-            go.Scatter(
-                x=[min(specimen_table['Drawn DTTM']),max(specimen_table['Drawn DTTM'])],
-                y=[3*outpatient_baseline,3*outpatient_baseline],
-                mode='lines',
-                name='3.0x OP Base',
-                line=dict(
-                    color="#FF0000",
-                    width=0.75,
-                )
-            )
-        )
     return(dcc.Graph(id='scatter-plot',figure=fig))
 
-def make_spectable(df:pd.DataFrame,slctd_mrn:list[str])->pd.DataFrame:
-    filt_mrn=[x in slctd_mrn for x in df['EPIC_MRN']]
-    dff=df.loc[filt_mrn]
+def make_spectable(data_index:encounter_index.EncounterIndex,slctd_mrn:list[str],delta:pd.DataFrame=None)->pd.DataFrame:
+    '''Returns specimen table pandas dataframe for selected MRN, including live rows from delta if given'''
+    dff=encounter_index.rows_for(data_index,'EPIC_MRN',slctd_mrn)
+    if delta is not None and len(delta):
+        dff=pd.concat([dff,delta.loc[delta['EPIC_MRN'].isin(slctd_mrn or [])]],ignore_index=True)
     cols_spectable={'ACCESSION':'Acc #',
         'NAME_FULL_FORMATTED':'NAME',
         'BIRTH_DT_TM':'DOB',
@@ -274,8 +353,8 @@ def make_spectable(df:pd.DataFrame,slctd_mrn:list[str])->pd.DataFrame:
     specimen_table=specimen_table.sort_values(by='Drawn DTTM',ascending=False,ignore_index=True)
     return(specimen_table)
 
-def make_specdashtable(specimen_table : pd.DataFrame)->dash_table.DataTable:
-    '''Returns dashtable of available specimen for selected MRN'''
+def make_specdashtable(specimen_table : pd.DataFrame,records : list[dict]=None)->dash_table.DataTable:
+    '''Returns dashtable of available specimen for selected MRN, from precomputed first page records if given'''
     # week_ago = datetime.today() - timedelta(days=7)
     # week_agoDate = week_ago.strftime("%Y-%m-%d %H:%M:%S")
     specimen_dashtable=dash_table.DataTable(
@@ -352,20 +431,23 @@ def make_specdashtable(specimen_table : pd.DataFrame)->dash_table.DataTable:
             'hideable':True,
         }              
     ],
-    data=specimen_table.to_dict('records'),  # the contents of the table
+    data=records if records is not None else specimen_table.iloc[:SPEC_PAGE_SIZE].to_dict('records'),  # first page, later pages come from page_specdashtable
     hidden_columns=['MRN','NAME','DOB','Drawn DTTM','OP Base'],
     editable=True,              # allow editing of data inside all cells
-    filter_action="native",     # allow filtering of data by user ('native') or not ('none')
-    sort_action="native",       # enables data to be sorted per-column by user or not ('none')
+    filter_action="custom",     # filtering is done on the server by page_specdashtable
+    filter_query='',
+    sort_action="custom",       # sorting is done on the server by page_specdashtable
     sort_mode="single",         # sort across 'multi' or 'single' columns
     column_selectable="multi",  # allow users to select 'multi' or 'single' columns
     row_selectable="multi",     # allow users to select 'multi' or 'single' rows
     row_deletable=False,         # choose if user can delete a row (True) or not (False)
     selected_columns=[],        # ids of columns that user selects
     selected_rows=[],           # indices of rows that user selects
-    page_action="native",       # all data is passed to the table up-front or not ('none')
+    sort_by=[],
+    page_action="custom",       # only the current page is sent to the browser
     page_current=0,             # page number that user is on
-    page_size=10,                # number of rows visible per page
+    page_size=SPEC_PAGE_SIZE,   # number of rows visible per page
+    page_count=max(1,-(-len(specimen_table)//SPEC_PAGE_SIZE)),
     style_data_conditional=[
             # {
             #     'if': {
@@ -441,23 +523,42 @@ def make_inventorydashtable(inventory_table : pd.DataFrame)->dash_table.DataTabl
             'hideable':True,
         }              
     ],
-    data=inventory_table.to_dict('records'),  # the contents of the table
+    data=inventory_table.iloc[:INVENTORY_PAGE_SIZE].to_dict('records'),  # first page, later pages come from update_inventory
     hidden_columns=['MRN','Tube','OP Base'],
     editable=True,              # allow editing of data inside all cells
-    filter_action="native",     # allow filtering of data by user ('native') or not ('none')
-    sort_action="native",       # enables data to be sorted per-column by user or not ('none')
+    filter_action="custom",     # filtering is done on the server by update_inventory
+    filter_query='',
+    sort_action="custom",       # sorting is done on the server by update_inventory
     sort_mode="single",         # sort across 'multi' or 'single' columns
     column_selectable="multi",  # allow users to select 'multi' or 'single' columns
     row_selectable="multi",     # allow users to select 'multi' or 'single' rows
     row_deletable=False,         # choose if user can delete a row (True) or not (False)
     selected_columns=[],        # ids of columns that user selects
     selected_rows=[],           # indices of rows that user selects
-    page_action="native",       # all data is passed to the table up-front or not ('none')
+    sort_by=[],
+    page_action="custom",       # only the current page is sent to the browser
     page_current=0,             # page number that user is on
-    page_size=30,                # number of rows visible per page
+    page_size=INVENTORY_PAGE_SIZE,  # number of rows visible per page
+    page_count=max(1,-(-len(inventory_table)//INVENTORY_PAGE_SIZE)),
     )    
     return(inventory_dashtable)
 
+def load_inventory()->pd.DataFrame:
+    '''Returns the shared inventory'''
+    with closing(inventory_store.connect()) as conn:
+        return(inventory_store.load(conn))
+
+
+def build_specimens(snapshot : refresher.DataSnapshot,slctd_mrn : tuple,delta : live.LiveDelta=None)->tuple:
+    '''Returns specimen table, its first page records and its uncolored figure for the selected MRN'''
+    specimen_table=make_spectable(snapshot.index,list(slctd_mrn),delta.df if delta is not None else None)
+    records=specimen_table.iloc[:SPEC_PAGE_SIZE].to_dict('records')
+    figure=make_scatterplot(specimen_table,["#808080"]*len(specimen_table)).figure
+    return(specimen_table,records,figure)
+
+
+data_refresher.listeners.append(prepare_maintable) # main table is built when a version is published, not on the first page load
+prepare_maintable(data_refresher.current())
 
 
 #%% Initialize App and authenticate user
@@ -467,101 +568,217 @@ auth = dash_auth.BasicAuth(
     app,
     VALID_USERNAME_PASSWORD_PAIRS
 )
+metrics.instrument_server(app) # callback latency histograms and stage timings at /metrics
 
-##%% Callback functions ## need to add trigger context and not remake specimen table if that is what triggerd
+##%% Callback functions
 @app.callback(
     [Output(component_id='plot-container', component_property='children'),
-    Output(component_id='specimentable-container', component_property='children')],
-    [Input(component_id='main-dashtable', component_property='derived_virtual_selected_row_ids'),
-    Input('specimen-dashtable',component_property='selected_rows')])
-def update_elements(slctd_mrn,slctd_rows):
-    '''Updates app elements based on user selections'''
-    specimen_table=make_spectable(df,slctd_mrn)
-    if ctx.triggered_id == 'specimen-dashtable':
-        colors=["#808080" if row['Acc #'] not in specimen_table.loc[slctd_rows,'Acc #'].values else '#3498DB' for i,row in specimen_table.iterrows() ]
-        return([
-            make_scatterplot(specimen_table,colors),
-            dash.no_update
-        ])
-    else:
-        colors=["#808080" for i,row in specimen_table.iterrows() ]
-        return([
-            make_scatterplot(specimen_table,colors),
-            make_specdashtable(specimen_table)
+    Output(component_id='specimentable-container', component_property='children'),
+    Output(component_id='specimen-selected', component_property='data', allow_duplicate=True)],
+    Input(component_id='main-selected', component_property='data'))
+def update_elements(slctd_mrn):
+    '''Updates app elements based on user selections, starting the new specimen table with no rows checked'''
+    slctd_mrn=tuple(slctd_mrn or [])
+    snapshot,delta,_=current_data()
+    specimen_table,records,figure=specimen_cache.get(snapshot,(slctd_mrn,delta.seq),lambda snapshot: build_specimens(snapshot,slctd_mrn,delta))
+    return([
+        dcc.Graph(id='scatter-plot',figure=figure),
+        make_specdashtable(specimen_table,records),
+        []
     ])
 
-    
+def keep_selection(page_selected_ids,data,selected_ids):
+    '''Returns the ids selected anywhere in a table after a check or uncheck on its current page'''
+    selected=datatable_query.merge_selection(selected_ids,data,page_selected_ids)
+    return(dash.no_update if selected==(selected_ids or []) else selected)
+
+for table_id in ('main','specimen','inventory'): # custom paging: selected_row_ids only covers the page on screen
+    app.callback(
+        Output(f'{table_id}-selected','data'),
+        Input(f'{table_id}-dashtable','selected_row_ids'),
+        [State(f'{table_id}-dashtable','data'),
+        State(f'{table_id}-selected','data')])(keep_selection)
+
+# checked specimen rows recolor their markers in the browser; the accession number is the first customdata (hover) field of each point
+app.clientside_callback(
+    """
+    function(slctd_ids, figure) {
+        if (!figure || !figure.data || !figure.data.length) {
+            return window.dash_clientside.no_update;
+        }
+        const selected = new Set(slctd_ids || []);
+        const points = figure.data[0];
+        const color = (points.customdata || []).map(c => selected.has(c[0]) ? '#3498DB' : '#808080');
+        const marker = Object.assign({}, points.marker, {color: color});
+        return Object.assign({}, figure, {data: [Object.assign({}, points, {marker: marker})].concat(figure.data.slice(1))});
+    }
+    """,
+    Output('scatter-plot','figure'),
+    Input('specimen-selected','data'),
+    State('scatter-plot','figure')
+)
+
+@app.callback(
+    [Output('main-dashtable','data'),
+    Output('main-dashtable','page_count'),
+    Output('main-dashtable','selected_rows')],
+    [Input('main-dashtable','page_current'),
+    Input('main-dashtable','page_size'),
+    Input('main-dashtable','sort_by'),
+    Input('main-dashtable','filter_query'),
+    Input('live-seq','data')],
+    State('main-selected','data'))
+def page_maindashtable(page_current,page_size,sort_by,filter_query,_live,slctd_ids):
+    '''Returns the requested page of the filtered and sorted main table'''
+    main_table,_=current_maintable()
+    data,page_count=datatable_query.query_prepared(main_table,page_current,page_size,sort_by,filter_query)
+    return([data,page_count,datatable_query.selected_rows(data,slctd_ids)])
+
 @app.callback(
+    [Output('specimen-dashtable','data'),
+    Output('specimen-dashtable','page_count'),
+    Output('specimen-dashtable','selected_rows')],
+    [Input('specimen-dashtable','page_current'),
+    Input('specimen-dashtable','page_size'),
+    Input('specimen-dashtable','sort_by'),
+    Input('specimen-dashtable','filter_query')],
+    [State('main-selected','data'),
+    State('specimen-selected','data')])
+def page_specdashtable(page_current,page_size,sort_by,filter_query,slctd_mrn,slctd_ids):
+    '''Returns the requested page of the filtered and sorted specimen table'''
+    slctd_mrn=tuple(slctd_mrn or [])
+    snapshot,delta,_=current_data()
+    specimen_table,_,_=specimen_cache.get(snapshot,(slctd_mrn,delta.seq),lambda snapshot: build_specimens(snapshot,slctd_mrn,delta))
+    data,page_count=datatable_query.query_page(specimen_table,page_current,page_size,sort_by,filter_query)
+    return([data,page_count,datatable_query.selected_rows(data,slctd_ids)])
+
+HIGHLIGHT_SELECTED_ROWS="""
+    function(selected_rows) {
+        return (selected_rows || []).map(i => ({'if': {'row_index': i}, 'background_color': '#D2F3FF'}));
+    }
+    """ # runs in the browser, no server round trip
+
+app.clientside_callback(
+    HIGHLIGHT_SELECTED_ROWS,
     Output('main-dashtable', 'style_data_conditional'),
-    [Input('main-dashtable', 'selected_rows')]
+    Input('main-dashtable', 'selected_rows')
 )
-def highlight_slctdrowmain(selected_rows):
-    return [{
-        'if': {'row_index': i},
-        'background_color': '#D2F3FF'
-    } for i in selected_rows]
 
-@app.callback(
+app.clientside_callback(
+    HIGHLIGHT_SELECTED_ROWS,
     Output('specimen-dashtable', 'style_data_conditional'),
     Input('specimen-dashtable', 'selected_rows')
 )
-def highlight_slctdrowspec(selected_rows):
-    return [{
-        'if': {'row_index': i},
-        'background_color': '#D2F3FF'
-    } for i in selected_rows]
 
 @app.callback(
-    Output('inventorytable-container', 'children'),
-    Input('inventory-button', 'n_clicks'),
-    State('inventory-dashtable','data'),
-    State('specimen-dashtable','data'),
-    State('specimen-dashtable','selected_rows')
-)
-def update_inventory(_,inventory,data,slctd_rows):
-    dff=pd.DataFrame(data).iloc[slctd_rows]
-    new_inventory_table=pd.concat([pd.DataFrame(inventory),dff],axis=0).drop_duplicates().reset_index(drop=True)
-    return(make_inventorydashtable(new_inventory_table))
+    [Output('inventory-dashtable','data'),
+    Output('inventory-dashtable','page_count'),
+    Output('inventory-dashtable','selected_rows'),
+    Output('inventory-selected','data',allow_duplicate=True)],
+    [Input('inventory-button','n_clicks'),
+    Input('remove-button','n_clicks'),
+    Input('inventory-dashtable','page_current'),
+    Input('inventory-dashtable','page_size'),
+    Input('inventory-dashtable','sort_by'),
+    Input('inventory-dashtable','filter_query')],
+    [State('main-selected','data'),
+    State('specimen-selected','data'),
+    State('inventory-selected','data')])
+def update_inventory(_add,_remove,page_current,page_size,sort_by,filter_query,slctd_mrn,slctd_specimens,slctd_inventory):
+    '''Adds checked specimen to or removes checked rows from the shared inventory, returns the requested inventory page'''
+    user=flask.request.authorization.username if flask.request.authorization else None
+    with closing(inventory_store.connect()) as conn:
+        if ctx.triggered_id=='inventory-button':
+            slctd_mrn=tuple(slctd_mrn or [])
+            snapshot,delta,_=current_data()
+            specimen_table,_,_=specimen_cache.get(snapshot,(slctd_mrn,delta.seq),lambda snapshot: build_specimens(snapshot,slctd_mrn,delta))
+            inventory_store.add(conn,specimen_table.loc[specimen_table['id'].isin(slctd_specimens or [])].to_dict('records'),user)
+        elif ctx.triggered_id=='remove-button':
+            inventory_store.remove(conn,slctd_inventory or [],user)
+            slctd_inventory=[]
+        inventory=inventory_store.load(conn)
+    data,page_count=datatable_query.query_page(inventory,page_current,page_size,sort_by,filter_query)
+    return([data,page_count,datatable_query.selected_rows(data,slctd_inventory),
+        [] if ctx.triggered_id=='remove-button' else dash.no_update])
 
 @app.callback(
-    Output("download-inventory-csv", "data"),
-    Input("download-button", "n_clicks"),
-    State('inventory-dashtable','data'),
-    prevent_initial_call=True,
-)
-def func(_,data):
-    dff=pd.DataFrame(data)
-    return dcc.send_data_frame(dff.to_csv, f"{datetime.now().strftime('%Y%m%d %H%M')} AKI_samples.csv")
-
-
-app.layout = dbc.Container([
-    html.H1(children='AKI specimen finder v0.0'),
-    html.Div(f"Last data refresh: {datetime.now().strftime('%D %I:%m:%p')}"),
-    html.Br(),
-    dbc.Row(make_maindashtable(make_maintable(df))),
-    dbc.Row([
-        dbc.Col(make_scatterplot(make_spectable(df,[]),[]),id='plot-container',width=5),
-        dbc.Col(make_specdashtable(make_spectable(df,[])),id='specimentable-container',width=7)   
-    ],
-    align='start',
-    className='g-0 mt-0'),
-    dbc.Row(
-        [dbc.Col(width=10),
-        dbc.Col(html.Button('Inventory selected rows',id='inventory-button',n_clicks=0))]
-    ),
-    dbc.Row(make_inventorydashtable(make_spectable(df,[])),id='inventorytable-container'),
-    dbc.Row(
-        [dbc.Col(width=10),
-        dbc.Col(html.Button('Download inventory',id='download-button',n_clicks=0)),
-        dcc.Download(id="download-inventory-csv")]
-    ),
-    html.Br(),
-    html.Div('Created by Mark A Zaydman (zaydmanm@wustl.edu)'),
-])
+    [Output('live-seq','data'),
+    Output('live-status','children')],
+    Input('live-interval','n_intervals'),
+    State('live-seq','data'))
+def check_live(n_intervals,seen):
+    '''Signals the tables to refresh when the live feed has staged new results'''
+    snapshot,delta,key=current_data()
+    if key==seen:
+        return([dash.no_update,dash.no_update])
+    return([key,live_status(delta)])
+
+def live_status(delta : live.LiveDelta)->str:
+    '''Returns a one line summary of the live feed for the page header'''
+    if delta.polled_at is None:
+        return('')
+    n_aki=int(delta.df['aki_sample'].notna().sum()) if len(delta.df) else 0
+    return(f"Live: {len(delta.df)} new results, {n_aki} aki, as of {delta.polled_at.strftime('%I:%M %p')}")
+
+@app.server.route('/main-table.json')
+def download_maintable():
+    '''Returns the current main table as JSON records, serialized once per data version'''
+    main_table,key=current_maintable()
+    response=flask.Response(main_table.payload,mimetype='application/json')
+    response.set_etag(key)
+    return(response.make_conditional(flask.request))
+
+@app.server.route('/inventory.csv')
+def download_inventory():
+    '''Streams the shared inventory as csv straight from the store'''
+    def generate():
+        with closing(inventory_store.connect()) as conn:
+            yield from inventory_store.iter_csv(conn)
+    filename=f"{datetime.now().strftime('%Y%m%d %H%M')} AKI_samples.csv"
+    return(flask.Response(generate(),mimetype='text/csv',headers={'Content-Disposition':f'attachment; filename="{filename}"'}))
+
+
+def serve_layout():
+    '''Returns page layout for the current data snapshot, evaluated on each page load'''
+    snapshot,delta,key=current_data()
+    data_index=snapshot.index
+    return dbc.Container([
+        html.H1(children='AKI specimen finder v0.0'),
+        html.Div(f"Last data refresh: {snapshot.refreshed_at.strftime('%D %I:%M %p')}"),
+        html.Div(live_status(delta),id='live-status'),
+        dcc.Interval(id='live-interval',interval=LIVE_CHECK_SECONDS*1000,disabled=live_feed.interval_minutes<=0),
+        dcc.Store(id='live-seq',data=key),
+        dcc.Store(id='main-selected',data=[]), # ids selected on any page of each table
+        dcc.Store(id='specimen-selected',data=[]),
+        dcc.Store(id='inventory-selected',data=[]),
+        html.Br(),
+        dbc.Row(make_maindashtable(table_cache.get(snapshot,('main_table',delta.seq),lambda snapshot: make_live_maintable(snapshot,delta)))),
+        dbc.Row([
+            dbc.Col(make_scatterplot(make_spectable(data_index,[]),[]),id='plot-container',width=5),
+            dbc.Col(make_specdashtable(make_spectable(data_index,[])),id='specimentable-container',width=7)   
+        ],
+        align='start',
+        className='g-0 mt-0'),
+        dbc.Row(
+            [dbc.Col(width=10),
+            dbc.Col(html.Button('Inventory selected rows',id='inventory-button',n_clicks=0))]
+        ),
+        dbc.Row(make_inventorydashtable(load_inventory()),id='inventorytable-container'),
+        dbc.Row(
+            [dbc.Col(width=8),
+            dbc.Col(html.Button('Remove selected rows',id='remove-button',n_clicks=0)),
+            dbc.Col(html.A(html.Button('Download inventory',id='download-button'),href='/inventory.csv'))]
+        ),
+        html.Br(),
+        html.Div('Created by Mark A Zaydman (zaydmanm@wustl.edu)'),
+    ])
+
+app.layout = serve_layout
 
 ##%% Run app
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,format='%(asctime)s %(name)s %(levelname)s %(message)s')
     app.run_server(host='0.0.0.0',port=8088)
     
     
@@ -8,46 +8,95 @@ Purpose: Module of analytical tools for identifying aki samples and encounters g
 
 Functions:
 
-  main()->pd.DataFrame -  main function, will evoke subordinate functions to generate processed data
+  main(df: pd.DataFrame, workers: int=WORKERS, outpatient_history: pd.DataFrame=None, hours: float=state_store.WINDOW_HOURS)->pd.DataFrame -  main function, will evoke subordinate functions to generate processed data
+  main_incremental(df: pd.DataFrame, conn: sqlite3.Connection, evict_before: datetime=None, outpatient_history: pd.DataFrame=None, hours: float=state_store.WINDOW_HOURS)->pd.DataFrame - stages only new results against stored encounter state
+  stage_with_state(df: pd.DataFrame, conn: sqlite3.Connection, commit: bool=True, outpatient_history: pd.DataFrame=None, hours: float=state_store.WINDOW_HOURS)->pd.DataFrame - cleans and stages new results with baselines continued from the state store
+  parse_datetime(values: pd.Series)->pd.Series -> returns values as datetime64, parsed with DATETIME_FORMAT when it fits
+  excluded_names(names: pd.Series)->np.ndarray -> returns True where the patient name marks a CAP sample or test patient
   clean_data(df: pd.DataFrame)->pd.DataFrame -> returns data cleaned of test/cap samples, and nan results, and with casting key datatypes
+  clean_chunks(chunks: Iterable[pd.DataFrame])->Iterator[pd.DataFrame] -> yields cleaned copy of each chunk, e.g. of queries.main_chunks()
   calc_encounter_baseline(row: pd.Series, df: pd.DataFrame)->pd.Series: Returns lowest previous cr for this encounter
+  calc_encounter_baselines(df: pd.DataFrame)->pd.Series: Returns lowest previous cr for this encounter for every row in one sorted pass
   calc_twoday_baseline(row: pd.Series,df: pd.DataFrame)->pd.Series: Returns lowest previous cr within the past 48 hours
+  calc_twoday_baselines(df: pd.DataFrame, hours: float=state_store.WINDOW_HOURS)->pd.Series: Returns lowest previous cr within the past window for every row with a sliding minimum
   encode_race(race_str: str)->float: Returns 1.212 it pt race is black else 1
   encode_sex(sex_str: str)->float: Returns sex coefficient for mdrd - 0.72 if female, 1 if male, else None
+  calc_outpatient_baselines(df: pd.DataFrame, history: pd.DataFrame, days: float=365)->pd.Series: Returns median of the patient's outpatient results in the year before each row
+  shard_encounters(encntr_id: pd.Series, n_shards: int)->np.ndarray: Returns shard number of every row from a hash of its encounter
+  calc_baselines_parallel(df: pd.DataFrame, workers: int=WORKERS, hours: float=state_store.WINDOW_HOURS)->tuple[pd.Series,pd.Series]: Returns encounter and two day baselines, computed per encounter shard in a process pool
   calc_mdrd_baseline(row: pd.Series)->float: Returns estimated creatinine using mdrd formula if pt demographics are known, else None
+  calc_mdrd_baselines(df: pd.DataFrame)->pd.Series: Returns mdrd estimated creatinine for every row, nan where age is unknown
   stage_aki(result_val: float, baseline: float)->str: Returns stage of AKI according to KDIGO criteria
   apply_kdigo(result_val: float,baseline: float,twoday_baseline)->str: returns stage if KDIGO criteria satisfied, else False
   is_aki(row: pd.Series)->int: returns 1 if sample meets KDIGO aki critera, else 0
+  select_baselines(outpatient_baseline, encounter_baseline, mdrd_baseline)->np.ndarray: Returns the baseline each row is staged against
+  classify_kdigo(result_val, outpatient_baseline, encounter_baseline, twoday_baseline, mdrd_baseline)->pd.Series: Returns KDIGO stage for every row as a categorical, nan if not aki
   aki_encounter(row: pd.Series,df:pd.DataFrame)->bool: Return True if any sample from this encounter is aki else false
+  calc_aki_encounters(df: pd.DataFrame)->pd.Series: Returns True for every row whose encounter has any aki sample
 
   
 '''
 
 #%% imports 
-import queries
+import state_store
+import outpatient_store
+import metrics
+import sqlite3
+import argparse
+import re
+import os
 import pandas as pd
 import numpy as np 
-import seaborn as sns
-import matplotlib.pyplot as plt
-from matplotlib.dates import DateFormatter
-import matplotlib.dates as mdates
-from datetime import date,timedelta
+from datetime import date,datetime,timedelta
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Iterable,Iterator
+
+KDIGO_STAGES=['Stage 1','Stage 2','Stage 3']
+EXCLUDED_NAMES=re.compile(r'^(?:cap|ioh|testpatient)\b',re.IGNORECASE) # CAP samples (old and new name format) and test patients
+DATETIME_COLS=['DRAWN_DT_TM','RECEIVED_DT_TM','PERFORMED_DT_TM']
+DATETIME_FORMAT='%Y-%m-%d %H:%M:%S'
+CATEGORY_COLS=['NAME_FULL_FORMATTED','EPIC_MRN','PATIENT_SEX','PATIENT_RACE','TUBE_TYPE','TASK_ASSAY'] # few distinct values per frame
+WORKERS=int(os.environ.get('AKI_ANALYTICS_WORKERS',1)) # processes for the per-encounter baselines, 1 runs them in process
+SHARDS_PER_WORKER=4 # smaller shards even out encounters of very different sizes
+OVERLAP_HOURS=float(os.environ.get('AKI_OVERLAP_HOURS',24)) # incremental runs re-query this far behind the high-water mark for late verified results
 
 #%% helper functions
+def parse_datetime(values: pd.Series)->pd.Series:
+  '''Returns values as datetime64, parsed with DATETIME_FORMAT when it fits'''
+  if pd.api.types.is_datetime64_any_dtype(values):
+    return(values)
+  try:
+    return(pd.to_datetime(values,format=DATETIME_FORMAT))
+  except (ValueError,TypeError):
+    return(pd.to_datetime(values)) # e.g. fractional seconds from a csv round trip
+
+def excluded_names(names: pd.Series)->np.ndarray:
+  '''Returns True where the patient name marks a CAP sample or test patient, matching each distinct name once'''
+  names=names.astype('category')
+  hit=np.asarray(names.cat.categories.astype(str).str.contains(EXCLUDED_NAMES),dtype=bool)
+  return(np.append(hit,False)[names.cat.codes.to_numpy()]) # code -1 (missing name) is kept
+
 def clean_data(df: pd.DataFrame)->pd.DataFrame:
   '''returns cleaned copy of data'''
-  filt_cap=df['NAME_FULL_FORMATTED'].str.contains(r'^cap\b',case=False) # remove CAP samples
-  filt_ioh=df['NAME_FULL_FORMATTED'].str.contains(r'^ioh\b',case=False) # also for CAP samples (new name format)
-  filt_testpt=df['NAME_FULL_FORMATTED'].str.contains(r'^testpatient\b',case=False) # remove test patients
-  filt_nantask=df['TASK_ASSAY'].isna()
-  filt_nandttm=df[['DRAWN_DT_TM','RECEIVED_DT_TM']].isna().any(axis=1)
-  df_cleaned=df.loc[~(filt_cap|filt_testpt|filt_ioh|filt_nantask|filt_nandttm)].reset_index(drop=True)
-  df_cleaned['DRAWN_DT_TM']=pd.to_datetime(df_cleaned['DRAWN_DT_TM'])
-  df_cleaned['RECEIVED_DT_TM']=pd.to_datetime(df_cleaned['RECEIVED_DT_TM'])
-  df_cleaned['PERFORMED_DT_TM']=pd.to_datetime(df_cleaned['PERFORMED_DT_TM'])
-  df_cleaned['RESULT_VAL']=df_cleaned['RESULT_VAL'].apply(lambda x: pd.to_numeric(x,errors='coerce'))
+  filt_excluded=excluded_names(df['NAME_FULL_FORMATTED']) # remove CAP samples and test patients
+  filt_nantask=df['TASK_ASSAY'].isna().to_numpy()
+  filt_nandttm=df[['DRAWN_DT_TM','RECEIVED_DT_TM']].isna().any(axis=1).to_numpy()
+  df_cleaned=df.loc[~(filt_excluded|filt_nantask|filt_nandttm)].reset_index(drop=True)
+  for col in DATETIME_COLS:
+    df_cleaned[col]=parse_datetime(df_cleaned[col])
+  df_cleaned['RESULT_VAL']=pd.to_numeric(df_cleaned['RESULT_VAL'],errors='coerce')
+  for col in CATEGORY_COLS:
+    if col in df_cleaned:
+      df_cleaned[col]=df_cleaned[col].astype('category')
   return(df_cleaned)
 
+def clean_chunks(chunks: Iterable[pd.DataFrame])->Iterator[pd.DataFrame]:
+  '''yields cleaned copy of each chunk; cleaning is row by row so chunks can be cleaned as they arrive'''
+  for chunk in chunks:
+    yield(clean_data(chunk))
+
 def calc_encounter_baseline(row: pd.Series, df: pd.DataFrame)->pd.Series:
   '''Returns lowest previous cr for this encounter'''
   filt_date=df['PERFORMED_DT_TM']<row['PERFORMED_DT_TM']
@@ -57,6 +106,43 @@ def calc_encounter_baseline(row: pd.Series, df: pd.DataFrame)->pd.Series:
   else:
     return(np.NaN)
 
+def _sort_by_encounter(df: pd.DataFrame)->tuple:
+  '''Returns row positions sorted by encounter then performed time, with encounter codes, times and values in that order'''
+  codes=pd.factorize(df['ENCNTR_ID'])[0] # nan encounters get -1 and never match another row
+  times=pd.to_datetime(df['PERFORMED_DT_TM']).to_numpy(dtype='datetime64[ns]').view('i8')
+  vals=pd.to_numeric(df['RESULT_VAL'],errors='coerce').to_numpy(dtype=float)
+  valid=np.flatnonzero((codes>=0)&~pd.isna(df['PERFORMED_DT_TM']).to_numpy()) # NaT never compares less than anything
+  order=valid[np.lexsort((valid,times[valid],codes[valid]))] # stable: ties keep frame order
+  return(order,codes[order],times[order],vals[order])
+
+def _block_starts(keys: list)->np.ndarray:
+  '''Returns, for each sorted row, the index where its run of equal keys begins'''
+  n=len(keys[0])
+  new_block=np.ones(n,dtype=bool)
+  if n:
+    new_block[1:]=np.logical_or.reduce([k[1:]!=k[:-1] for k in keys])
+  return(np.maximum.accumulate(np.where(new_block,np.arange(n),0)))
+
+def calc_encounter_baselines(df: pd.DataFrame)->pd.Series:
+  '''Returns lowest previous cr for this encounter for every row in one sorted pass
+
+  Matches calc_encounter_baseline row for row: rows with the same PERFORMED_DT_TM are not
+  each other's baseline, and, as with the builtin min over the frame, the baseline is nan when
+  the first prior row in frame order has a nan RESULT_VAL (later nan results are skipped).
+  '''
+  out=np.full(len(df),np.nan)
+  order,codes,times,vals=_sort_by_encounter(df)
+  if len(order):
+    enc_start=_block_starts([codes])
+    tie_start=_block_starts([codes,times])
+    run_min=pd.Series(np.where(np.isnan(vals),np.inf,vals)).groupby(codes).cummin().to_numpy()
+    run_first=pd.Series(order).groupby(codes).cummin().to_numpy() # earliest frame position seen so far
+    has_prior=tie_start>enc_start
+    prev=np.maximum(tie_start-1,0) # last row strictly before this timestamp
+    first_nan=np.isnan(pd.to_numeric(df['RESULT_VAL'],errors='coerce').to_numpy(dtype=float)[run_first[prev]])
+    out[order]=np.where(has_prior&~first_nan,run_min[prev],np.nan)
+  return(pd.Series(out,index=df.index))
+
 def calc_twoday_baseline(row: pd.Series,df: pd.DataFrame)->pd.Series:
   '''Returns lowest previous cr within the past 48 hours'''
   filt_date=(df['PERFORMED_DT_TM']<row['PERFORMED_DT_TM'])&(df['PERFORMED_DT_TM']>(row['PERFORMED_DT_TM']-np.timedelta64(48,'h')))
@@ -66,6 +152,49 @@ def calc_twoday_baseline(row: pd.Series,df: pd.DataFrame)->pd.Series:
   else:
     return(np.NaN)
 
+def calc_twoday_baselines(df: pd.DataFrame, hours: float=state_store.WINDOW_HOURS)->pd.Series:
+  '''Returns lowest previous cr within the past window for every row with a sliding minimum
+
+  The window is open at both ends like calc_twoday_baseline (earlier than now and later than now
+  minus the window) and nan results follow the same builtin min rules. Each encounter is walked
+  once in time order with two monotonic deques: one holding the running minimum result and one
+  holding the earliest frame position still inside the window.
+  '''
+  out=np.full(len(df),np.nan)
+  order,codes,times,vals=_sort_by_encounter(df)
+  frame_vals=pd.to_numeric(df['RESULT_VAL'],errors='coerce').to_numpy(dtype=float)
+  width=int(hours*3600*10**9) # ns
+  order,codes,times,vals=order.tolist(),codes.tolist(),times.tolist(),vals.tolist()
+  res=[np.nan]*len(order)
+  mins,firsts=deque(),deque() # (time, value) and (time, frame position), both increasing in the second item
+  i,n=0,len(order)
+  while i<n:
+    if i==0 or codes[i]!=codes[i-1]:
+      mins.clear()
+      firsts.clear()
+    t=times[i]
+    j=i
+    while j<n and codes[j]==codes[i] and times[j]==t: # rows sharing a timestamp are not each other's baseline
+      j+=1
+    cutoff=t-width
+    while mins and mins[0][0]<=cutoff:
+      mins.popleft()
+    while firsts and firsts[0][0]<=cutoff:
+      firsts.popleft()
+    if firsts and not np.isnan(frame_vals[firsts[0][1]]):
+      res[i:j]=[mins[0][1]]*(j-i)
+    for k in range(i,j):
+      if vals[k]==vals[k]: # skip nan
+        while mins and mins[-1][1]>=vals[k]:
+          mins.pop()
+        mins.append((t,vals[k]))
+      while firsts and firsts[-1][1]>=order[k]:
+        firsts.pop()
+      firsts.append((t,order[k]))
+    i=j
+  out[order]=res
+  return(pd.Series(out,index=df.index))
+
 def encode_race(race_str: str)->float:
   '''Returns 1.212 it pt race is black else 1'''
   if race_str=='Black':
@@ -91,6 +220,109 @@ def calc_mdrd_baseline(row: pd.Series)->float:
       est_cr = (egfr/175) / (age ** -0.203) / (race_coef) / (sex_coef) # MDRD formula
       return(est_cr)
   
+def calc_outpatient_baselines(df: pd.DataFrame, history: pd.DataFrame, days: float=outpatient_store.WINDOW_DAYS)->pd.Series:
+  '''Returns median of the patient's outpatient results in the year before each row, nan if there are none
+
+  history holds outpatient results (EPIC_MRN, PERFORMED_DT_TM, RESULT_VAL), e.g. from
+  outpatient_store.load_history. Rows and history are walked together per patient in time order,
+  feeding one RollingMedian that takes results performed before the row and expires those older
+  than the window, so each row costs a few binary searches rather than a fresh median.
+  '''
+  out=np.full(len(df),np.nan)
+  mrns=pd.concat([df['EPIC_MRN'].astype(object),history['EPIC_MRN'].astype(object)],ignore_index=True)
+  mrn_codes=pd.factorize(mrns.astype(str).where(mrns.notna()))[0] # compared as text, as stored; missing MRNs get -1
+  codes,h_codes=mrn_codes[:len(df)],mrn_codes[len(df):]
+  times=pd.to_datetime(df['PERFORMED_DT_TM']).to_numpy(dtype='datetime64[ns]').view('i8')
+  valid=np.flatnonzero((codes>=0)&~pd.isna(df['PERFORMED_DT_TM']).to_numpy())
+  order=valid[np.lexsort((times[valid],codes[valid]))].tolist()
+  h_times=pd.to_datetime(history['PERFORMED_DT_TM']).to_numpy(dtype='datetime64[ns]').view('i8')
+  h_vals=pd.to_numeric(history['RESULT_VAL'],errors='coerce').to_numpy(dtype=float)
+  h_valid=np.flatnonzero((h_codes>=0)&~pd.isna(history['PERFORMED_DT_TM']).to_numpy())
+  h_order=h_valid[np.lexsort((h_times[h_valid],h_codes[h_valid]))]
+  h_codes,h_times,h_vals=h_codes[h_order].tolist(),h_times[h_order].tolist(),h_vals[h_order].tolist()
+  codes,times=codes.tolist(),times.tolist()
+  width=int(days*24*3600*10**9) # ns
+  j,n_hist,current,window=0,len(h_codes),None,None
+  for i in order:
+    code,t=codes[i],times[i]
+    if code!=current:
+      current,window=code,outpatient_store.RollingMedian()
+      while j<n_hist and h_codes[j]<code:
+        j+=1
+    while j<n_hist and h_codes[j]==code and h_times[j]<t:
+      window.add(h_times[j],h_vals[j])
+      j+=1
+    window.expire(t-width)
+    out[i]=window.median()
+  return(pd.Series(out,index=df.index))
+
+def shard_encounters(encntr_id: pd.Series, n_shards: int)->np.ndarray:
+  '''Returns shard number of every row from a hash of its encounter, so each encounter lands in one shard'''
+  ids=pd.to_numeric(encntr_id,errors='coerce').to_numpy(dtype=float)
+  return((pd.util.hash_array(ids)%n_shards).astype(np.int64)) # nan encounters all share one shard
+
+def _baseline_shard(in_name: str, out_name: str, n: int, start: int, stop: int, hours: float):
+  '''Computes both per-encounter baselines for rows start:stop of the shared input into the shared output'''
+  shm_in=shared_memory.SharedMemory(name=in_name)
+  shm_out=shared_memory.SharedMemory(name=out_name)
+  try:
+    cols=np.ndarray((3,n),dtype=np.float64,buffer=shm_in.buf)
+    df=pd.DataFrame({'ENCNTR_ID':cols[0,start:stop].copy(),
+      'PERFORMED_DT_TM':cols[1,start:stop].view(np.int64).view('datetime64[ns]').copy(),
+      'RESULT_VAL':cols[2,start:stop].copy()})
+    out=np.ndarray((2,n),dtype=np.float64,buffer=shm_out.buf)
+    out[0,start:stop]=calc_encounter_baselines(df).to_numpy()
+    out[1,start:stop]=calc_twoday_baselines(df,hours).to_numpy()
+    del cols,out # release the shared buffers before closing them
+  finally:
+    shm_in.close()
+    shm_out.close()
+
+def calc_baselines_parallel(df: pd.DataFrame, workers: int=WORKERS, hours: float=state_store.WINDOW_HOURS)->tuple[pd.Series,pd.Series]:
+  '''Returns encounter and two day baselines for every row, computed per encounter shard in a process pool
+
+  Rows are grouped by shard (keeping frame order within each shard, which the nan and tie rules
+  depend on) into one shared memory block of encounter, performed time and result, so workers
+  read their rows without pickling the frame. Each worker writes its baselines into a shared
+  output block at the same positions, and the parent puts them back in frame order.
+  '''
+  n=len(df)
+  n_shards=max(1,workers*SHARDS_PER_WORKER)
+  shard=shard_encounters(df['ENCNTR_ID'],n_shards)
+  order=np.argsort(shard,kind='stable')
+  bounds=np.searchsorted(shard[order],np.arange(n_shards+1))
+  shm_in=shared_memory.SharedMemory(create=True,size=max(1,3*n*8))
+  shm_out=shared_memory.SharedMemory(create=True,size=max(1,2*n*8))
+  try:
+    cols=np.ndarray((3,n),dtype=np.float64,buffer=shm_in.buf)
+    cols[0]=pd.to_numeric(df['ENCNTR_ID'],errors='coerce').to_numpy(dtype=float)[order]
+    cols[1].view(np.int64)[:]=pd.to_datetime(df['PERFORMED_DT_TM']).to_numpy(dtype='datetime64[ns]').view(np.int64)[order]
+    cols[2]=pd.to_numeric(df['RESULT_VAL'],errors='coerce').to_numpy(dtype=float)[order]
+    out=np.ndarray((2,n),dtype=np.float64,buffer=shm_out.buf)
+    out[:]=np.nan
+    shards=[(start,stop) for start,stop in zip(bounds[:-1],bounds[1:]) if stop>start]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+      list(pool.map(_baseline_shard,*zip(*[(shm_in.name,shm_out.name,n,int(start),int(stop),hours) for start,stop in shards])))
+    baselines=np.empty((2,n))
+    baselines[:,order]=out
+    del cols,out
+  finally:
+    shm_in.close()
+    shm_in.unlink()
+    shm_out.close()
+    shm_out.unlink()
+  return(pd.Series(baselines[0],index=df.index),pd.Series(baselines[1],index=df.index))
+
+def calc_mdrd_baselines(df: pd.DataFrame)->pd.Series:
+  '''Returns mdrd estimated creatinine for every row, nan where age is unknown'''
+  egfr = 75 #eGFR assumed to be 75mL/min/1.73^m2
+  age=pd.to_numeric(df['PT_AGE'],errors='coerce').to_numpy(dtype=float)
+  race_coef=np.where(df['PATIENT_RACE'].to_numpy()=='Black',1.212,1.)
+  sex_coef=np.where(df['PATIENT_SEX'].to_numpy()=='Female',0.742,1.)
+  with np.errstate(invalid='ignore',divide='ignore'):
+    est_cr=np.where(age>0,(egfr/175)/(age ** -0.203)/race_coef/sex_coef,np.nan) # MDRD formula
+  return(pd.Series(est_cr,index=df.index))
+
 def stage_aki(result_val: float, baseline: float)->str:
   '''Returns stage of AKI according to KDIGO criteria'''
   if (((result_val/baseline)>3)|(result_val>4)):
@@ -110,31 +342,166 @@ def apply_kdigo(result_val: float,baseline: float,twoday_baseline)->str:
 
 def is_aki(row: pd.Series)->int:
   '''returns 1 if sample meets KDIGO aki critera, else 0'''
-  if row['OUTPATIENT_BASELINE']:
+  if pd.notna(row['OUTPATIENT_BASELINE']) and row['OUTPATIENT_BASELINE']:
     aki_ind=apply_kdigo(row['RESULT_VAL'],row['OUTPATIENT_BASELINE'],row['twoday_baseline'])
-  elif row['inpatient_baseline']:
-    aki_ind=apply_kdigo(row['RESULT_VAL'],row['inpatient_baseline'],row['twoday_baseline'])
+  elif pd.notna(row['encounter_baseline']) and row['encounter_baseline']:
+    aki_ind=apply_kdigo(row['RESULT_VAL'],row['encounter_baseline'],row['twoday_baseline'])
   else:
     aki_ind=apply_kdigo(row['RESULT_VAL'],row['mdrd_baseline'],row['twoday_baseline'])
   return(aki_ind)
     
+def select_baselines(outpatient_baseline,encounter_baseline,mdrd_baseline)->np.ndarray:
+  '''Returns the baseline each row is staged against: outpatient if known, else inpatient, else mdrd'''
+  op=pd.to_numeric(pd.Series(outpatient_baseline),errors='coerce').to_numpy(dtype=float)
+  ip=np.asarray(encounter_baseline,dtype=float)
+  mdrd=np.asarray(mdrd_baseline,dtype=float)
+  return(np.select(
+    [~np.isnan(op)&(op!=0),~np.isnan(ip)&(ip!=0)],
+    [op,ip],
+    default=mdrd))
+
+def classify_kdigo(result_val,outpatient_baseline,encounter_baseline,twoday_baseline,mdrd_baseline)->pd.Series:
+  '''Returns KDIGO stage for every row as a categorical, nan if not aki'''
+  result=np.asarray(result_val,dtype=float)
+  twoday=np.asarray(twoday_baseline,dtype=float)
+  baseline=select_baselines(outpatient_baseline,encounter_baseline,mdrd_baseline)
+  with np.errstate(invalid='ignore',divide='ignore'):
+    ratio=result/baseline
+    aki=(result>=baseline*1.5)|((result-twoday)>0.3)
+    codes=np.select([aki&((ratio>3)|(result>4)),aki&(ratio>2),aki],[2,1,0],default=-1)
+  index=result_val.index if isinstance(result_val,pd.Series) else None
+  return(pd.Series(pd.Categorical.from_codes(codes,categories=KDIGO_STAGES,ordered=True),index=index))
+
 def aki_encounter(row: pd.Series,df:pd.DataFrame)->bool:
   """Return True if any sample from this encounter is aki else false"""
-  return(df.loc[df.ENCNTR_ID==row['ENCNTR_ID'],'aki_sample'].any())
+  return(df.loc[df.ENCNTR_ID==row['ENCNTR_ID'],'aki_sample'].notna().any())
+
+def calc_aki_encounters(df: pd.DataFrame)->pd.Series:
+  '''Returns True for every row whose encounter has any aki sample'''
+  return(df['aki_sample'].notna().groupby(df['ENCNTR_ID']).transform('any').fillna(False).astype(bool))
 
 #%% main function
-def main(df: pd.DataFrame)->pd.DataFrame:
-  """Returns analyzed and processed data"""
-  df=clean_data(df)
-  df['encounter_baseline']=df.apply(calc_encounter_baseline,df=df,axis=1)
-  df['twoday_baseline']=df.apply(calc_twoday_baseline,df=df,axis=1)
-  df['mdrd_baseline']=df.apply(calc_mdrd_baseline,axis=1)
-  df['aki_sample']=df.apply(is_aki,axis=1)
-  df['aki_encounter']=df.apply(aki_encounter,df=df,axis=1)
+def main(df: pd.DataFrame, workers: int=WORKERS, outpatient_history: pd.DataFrame=None, hours: float=state_store.WINDOW_HOURS)->pd.DataFrame:
+  """Returns analyzed and processed data, timing each step (see metrics.py)
+
+  With workers>1 the per-encounter baselines are computed in a process pool, sharded by encounter.
+  With outpatient_history (see outpatient_store.py) OUTPATIENT_BASELINE is computed locally rather
+  than taken from the query.
+  """
+  with metrics.stage('analytics',len(df)) as total:
+    with metrics.stage('clean_data',len(df)) as stage:
+      df=clean_data(df)
+      stage['rows']=len(df)
+    if outpatient_history is not None:
+      with metrics.stage('outpatient_baseline',len(df)):
+        df['OUTPATIENT_BASELINE']=calc_outpatient_baselines(df,outpatient_history)
+    if workers>1 and len(df):
+      with metrics.stage('baselines_parallel',len(df)):
+        df['encounter_baseline'],df['twoday_baseline']=calc_baselines_parallel(df,workers,hours)
+    else:
+      with metrics.stage('encounter_baseline',len(df)):
+        df['encounter_baseline']=calc_encounter_baselines(df)
+      with metrics.stage('twoday_baseline',len(df)):
+        df['twoday_baseline']=calc_twoday_baselines(df,hours)
+    with metrics.stage('mdrd_baseline',len(df)):
+      df['mdrd_baseline']=calc_mdrd_baselines(df)
+    with metrics.stage('kdigo',len(df)) as stage:
+      df['aki_sample']=classify_kdigo(df['RESULT_VAL'],df['OUTPATIENT_BASELINE'],df['encounter_baseline'],df['twoday_baseline'],df['mdrd_baseline'])
+      stage['rows']=int(df['aki_sample'].notna().sum())
+    with metrics.stage('aki_encounter',len(df)):
+      df['aki_encounter']=calc_aki_encounters(df)
+    total['rows']=len(df)
+  return(df)
+
+def stage_with_state(df: pd.DataFrame, conn: sqlite3.Connection, commit: bool=True, outpatient_history: pd.DataFrame=None, hours: float=state_store.WINDOW_HOURS)->pd.DataFrame:
+  """Returns cleaned and staged new results, with baselines continued from the state store, and adds them to the store
+
+  Baselines see each encounter's earlier results through the rows carried in the state store,
+  so the new rows get the same values main would give them on the full history. The store keeps
+  the window it was built with; staging into it with a different one raises ValueError.
+  """
+  built_with=state_store.get_meta(conn,'window_hours')
+  if built_with is None:
+    state_store.set_meta(conn,'window_hours',repr(float(hours)),commit=False)
+  elif float(built_with)!=hours:
+    raise ValueError(f'state store holds a {built_with} hour two day window, not {hours}; start a new store to change it')
+  with metrics.stage('clean_data',len(df)) as stage:
+    df=clean_data(df)
+    stage['rows']=len(df)
+  if outpatient_history is not None:
+    with metrics.stage('outpatient_baseline',len(df)):
+      df['OUTPATIENT_BASELINE']=calc_outpatient_baselines(df,outpatient_history)
+  with metrics.stage('load_carry_rows',len(df)) as stage:
+    carry=state_store.load_carry_rows(conn,df['ENCNTR_ID'].dropna().unique())
+    stage['rows']=len(carry)
+  history=pd.concat([carry,df[['ENCNTR_ID','PERFORMED_DT_TM','RESULT_VAL']]],ignore_index=True)
+  with metrics.stage('encounter_baseline',len(history)):
+    df['encounter_baseline']=calc_encounter_baselines(history).to_numpy()[len(carry):]
+  with metrics.stage('twoday_baseline',len(history)):
+    df['twoday_baseline']=calc_twoday_baselines(history,hours).to_numpy()[len(carry):]
+  with metrics.stage('mdrd_baseline',len(df)):
+    df['mdrd_baseline']=calc_mdrd_baselines(df)
+  with metrics.stage('kdigo',len(df)) as stage:
+    df['aki_sample']=classify_kdigo(df['RESULT_VAL'],df['OUTPATIENT_BASELINE'],df['encounter_baseline'],df['twoday_baseline'],df['mdrd_baseline'])
+    stage['rows']=int(df['aki_sample'].notna().sum())
+  with metrics.stage('save_state',len(df)):
+    state_store.save_state(conn,df,hours,commit=commit)
+  return(df)
+
+def main_incremental(df: pd.DataFrame, conn: sqlite3.Connection, evict_before: datetime=None, outpatient_history: pd.DataFrame=None, hours: float=state_store.WINDOW_HOURS)->pd.DataFrame:
+  """Returns analyzed data for open encounters after staging only the new results in df (see stage_with_state)
+
+  Rows whose accession was staged by an earlier run are dropped first, so df may overlap the
+  previous query, e.g. results tied at the high-water mark or re-queried for late verification.
+  """
+  with metrics.stage('drop_staged',len(df)) as stage:
+    staged=state_store.staged_accessions(conn,df['ACCESSION'].dropna().unique())
+    df=df.loc[~df['ACCESSION'].astype(str).isin(staged)].reset_index(drop=True)
+    stage['rows']=len(df)
+  df=stage_with_state(df,conn,outpatient_history=outpatient_history,hours=hours)
+  with metrics.stage('update_samples',len(df)):
+    if evict_before is not None:
+      state_store.evict(conn,evict_before)
+    samples=state_store.load_samples(conn)
+    state_store.append_samples(conn,df.assign(NEW_RESULT_IND=0) if 'NEW_RESULT_IND' in df else df) # new today, old tomorrow
+  if df['PERFORMED_DT_TM'].notna().any():
+    last_run=max(df['PERFORMED_DT_TM'].max(),pd.Timestamp(state_store.get_meta(conn,'last_performed') or df['PERFORMED_DT_TM'].max()))
+    state_store.set_meta(conn,'last_performed',last_run.isoformat())
+  df=pd.concat([samples,df],ignore_index=True)
+  df['aki_sample']=pd.Categorical(df['aki_sample'],categories=KDIGO_STAGES,ordered=True)
+  df['aki_encounter']=calc_aki_encounters(df)
   return(df)
 
 if __name__=='__main__':
-  df=queries.main()
-  df=main(df)
-  df.to_csv('prototype.csv')
+  import queries # LIS access and parquet output are only needed when run as a script
+  import snapshots
+  import logging
+  logging.basicConfig(level=logging.INFO,format='%(asctime)s %(name)s %(levelname)s %(message)s') # stage timings from metrics.py
+  parser=argparse.ArgumentParser(description='Stage aki samples from LIS Cr results')
+  parser.add_argument('--incremental',action='store_true',help='only fetch and stage results since the last run, using the local state store')
+  parser.add_argument('--state-db',default=state_store.STATE_DB,help='path of the incremental state store')
+  parser.add_argument('--evict-days',type=float,default=7,help='drop encounters with no new results for this many days')
+  parser.add_argument('--overlap-hours',type=float,default=OVERLAP_HOURS,help='re-query this far behind the last performed time, for results verified late')
+  parser.add_argument('--twoday-hours',type=float,default=state_store.WINDOW_HOURS,help='window of the two day baseline, AKI_TWODAY_HOURS by default')
+  parser.add_argument('--workers',type=int,default=WORKERS,help='processes for the per-encounter baselines of a full run')
+  parser.add_argument('--outpatient-db',help='compute outpatient baselines from this local outpatient store instead of the query')
+  args=parser.parse_args()
+  if args.incremental:
+    conn=state_store.connect(args.state_db)
+    last_run=state_store.get_meta(conn,'last_performed')
+    df=queries.main(since=(pd.Timestamp(last_run)-timedelta(hours=args.overlap_hours)).to_pydatetime() if last_run else None)
+  else:
+    df=queries.main()
+  history=None
+  if args.outpatient_db:
+    op_conn=outpatient_store.connect(args.outpatient_db)
+    outpatient_store.update(op_conn,queries.main_outpatient)
+    history=outpatient_store.load_history(op_conn,df['EPIC_MRN'].dropna().unique())
+    op_conn.close()
+  if args.incremental:
+    df=main_incremental(df,conn,evict_before=datetime.now()-timedelta(days=args.evict_days),outpatient_history=history,hours=args.twoday_hours)
+    conn.close()
+  else:
+    df=main(df,args.workers,outpatient_history=history,hours=args.twoday_hours)
+  snapshots.write_snapshot(df,'analyzed')
   
\ No newline at end of file
@@ -0,0 +1,142 @@
+'''
+backends.py
+
+Purpose: Database backends for queries.py - a pooled Oracle LIS backend and a local SQLite stand-in for offline runs and benchmarks
+
+Classes:
+
+  OracleBackend(pool_max: int=POOL_MAX): Pooled sessions on the LIS, connection details from the environment as before
+  SQLiteBackend(path: str): Local database holding a cr_results table with the same columns as the LIS query, and optionally outpatient_cr_results
+
+Functions:
+
+  get_backend()->Backend: Returns the process wide backend chosen by AKI_DB_BACKEND ('oracle' or 'sqlite'), created on first use
+  set_backend(backend: Backend): Replaces the process wide backend
+  load_fixture(df: pd.DataFrame, path: str, table: str=FIXTURE_TABLE): Writes df as the cr_results (or given) table of a local SQLite backend
+
+'''
+
+#%% imports
+import os
+import sqlite3
+import threading
+import pandas as pd
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import datetime
+
+ORACLE_CLIENT_LIB=os.environ.get('ORACLE_CLIENT_LIB',r'/opt/oracle/instantclient_21_5')
+POOL_MAX=int(os.environ.get('ORACLE_POOL_MAX',4))
+FIXTURE_TABLE='cr_results'
+OUTPATIENT_TABLE='outpatient_cr_results'
+
+#%% backends
+class Backend(ABC):
+  '''Interface used by queries.py'''
+  local_sql={} # {name of queries.py sql builder: sql to run instead}
+  mod_sql='MOD({col}, :n_parts)' # sql expression for col modulo :n_parts, used to hash partition queries
+
+  @abstractmethod
+  def connection(self):
+    '''Returns a context manager yielding a DB-API connection, returned to the backend afterwards'''
+
+  def execute(self, cur, sql: str, params: dict=None, arraysize: int=None):
+    '''Runs sql on cursor cur'''
+    if arraysize:
+      cur.arraysize=arraysize
+    cur.execute(sql,params or {})
+
+  def sql_for(self, name: str, build)->str:
+    '''Returns this backend's sql for the named builder, else build()'''
+    return(self.local_sql.get(name) or build())
+
+class OracleBackend(Backend):
+  '''Pooled sessions on the LIS, connection details from the environment as before'''
+
+  def __init__(self, pool_max: int=POOL_MAX):
+    import cx_Oracle # only needed when talking to the LIS
+    try:
+      cx_Oracle.init_oracle_client(lib_dir=ORACLE_CLIENT_LIB)
+    except cx_Oracle.ProgrammingError:
+      pass # already initialized in this process
+    self.cx_Oracle=cx_Oracle
+    dsn_tns = cx_Oracle.makedsn(os.environ.get('HOST_NAME'), os.environ.get('PORT_NUM'), service_name=os.environ.get('SERVICE_NAME'))
+    self.pool=cx_Oracle.SessionPool(user=os.environ.get('USER_NAME'),password=os.environ.get('PASSWORD'),dsn=dsn_tns,
+      min=1,max=pool_max,increment=1,threaded=True,getmode=cx_Oracle.SPOOL_ATTRVAL_WAIT)
+
+  def output_type_handler(self, cursor, name, default_type, size, precision, scale):
+    if default_type == self.cx_Oracle.CLOB:
+      return cursor.var(self.cx_Oracle.LONG_STRING, arraysize=cursor.arraysize)
+    if default_type == self.cx_Oracle.BLOB:
+      return cursor.var(self.cx_Oracle.LONG_BINARY, arraysize=cursor.arraysize)
+
+  @contextmanager
+  def connection(self):
+    conn=self.pool.acquire() # reuses an authenticated session when one is free
+    conn.outputtypehandler=self.output_type_handler
+    try:
+      yield(conn)
+    finally:
+      self.pool.release(conn)
+
+  def execute(self, cur, sql: str, params: dict=None, arraysize: int=None):
+    if arraysize:
+      cur.arraysize=arraysize
+      cur.prefetchrows=arraysize+1 # first batch arrives with the execute round trip
+    cur.execute(sql,params or {})
+
+class SQLiteBackend(Backend):
+  '''Local database holding a cr_results table with the same columns as the LIS query'''
+  local_sql={
+    'build_query':f'SELECT * FROM {FIXTURE_TABLE}',
+    'build_incremental_query':f'SELECT * FROM {FIXTURE_TABLE} WHERE PERFORMED_DT_TM >= :since',
+    'build_range_query':f'SELECT * FROM {FIXTURE_TABLE} WHERE PERFORMED_DT_TM >= :start AND PERFORMED_DT_TM < :end',
+    'build_history_query':f'SELECT * FROM {FIXTURE_TABLE}',
+    'build_outpatient_query':f'SELECT ACCESSION, EPIC_MRN, PERFORMED_DT_TM, RESULT_VAL FROM {OUTPATIENT_TABLE} WHERE PERFORMED_DT_TM > :since',
+  }
+  mod_sql='(CAST({col} AS INTEGER) % :n_parts)'
+
+  def __init__(self, path: str):
+    self.path=path
+
+  @contextmanager
+  def connection(self):
+    conn=sqlite3.connect(self.path)
+    try:
+      yield(conn)
+    finally:
+      conn.close()
+
+  def execute(self, cur, sql: str, params: dict=None, arraysize: int=None):
+    params={k:(v.isoformat(sep=' ') if isinstance(v,datetime) else v) for k,v in (params or {}).items()} # dates are stored as text
+    super().execute(cur,sql,params,arraysize)
+
+#%% helper functions
+_backend=None
+_backend_lock=threading.Lock()
+
+def get_backend()->Backend:
+  '''Returns the process wide backend chosen by AKI_DB_BACKEND ('oracle' or 'sqlite'), created on first use'''
+  global _backend
+  with _backend_lock:
+    if _backend is None:
+      if os.environ.get('AKI_DB_BACKEND','oracle')=='sqlite':
+        _backend=SQLiteBackend(os.environ.get('AKI_SQLITE_PATH','lis_fixture.sqlite'))
+      else:
+        _backend=OracleBackend()
+    return(_backend)
+
+def set_backend(backend: Backend):
+  '''Replaces the process wide backend'''
+  global _backend
+  with _backend_lock:
+    _backend=backend
+
+def load_fixture(df: pd.DataFrame, path: str, table: str=FIXTURE_TABLE):
+  '''Writes df as the cr_results (or given) table of a local SQLite backend'''
+  df=df.copy()
+  for col in df.columns:
+    if pd.api.types.is_datetime64_any_dtype(df[col]):
+      df[col]=df[col].dt.strftime('%Y-%m-%d %H:%M:%S')
+  with sqlite3.connect(path) as conn:
+    df.to_sql(table,conn,if_exists='replace',index=False)
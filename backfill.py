@@ -0,0 +1,123 @@
+'''
+backfill.py
+
+Purpose: Retrospective KDIGO staging over long date ranges in bounded memory, for validating the capture protocol
+
+The range is walked in time ordered chunks of performed dates. Each chunk is staged with baselines continued from
+a dedicated state store (see analytics.stage_with_state), so only one chunk and the carried per-encounter state are
+held at a time, and each day's staged results are written as a snapshot partition (snapshots.py, kind 'backfill').
+State and the checkpoint are committed together after a chunk's partitions are written, so an interrupted run
+resumes from the last finished chunk. A final pass adds aki_encounter, which needs every chunk of an encounter.
+
+Results match analytics.main over the whole range in the same row order (encounter, performed time, accession),
+except for results without a performed time, which no date range selects.
+
+Functions:
+
+  backfill(start: date, end: date, state_db: str=BACKFILL_DB, root: str=SNAPSHOT_ROOT, chunk_days: int=1, evict_days: float=None, fetch: Callable=queries.main_range, hours: float=state_store.WINDOW_HOURS)->list[date]: Stages results performed in [start, end), returns days written
+  finalize(start: date, end: date, conn: sqlite3.Connection, root: str=SNAPSHOT_ROOT): Adds aki_encounter to every backfill partition in [start, end)
+
+Usage:
+
+  python backfill.py 2022-01-01 2023-01-01 --state-db backfill_state.sqlite
+
+'''
+
+#%% imports
+import argparse
+import logging
+import sqlite3
+import pandas as pd
+import analytics
+import metrics
+import queries
+import snapshots
+import state_store
+from datetime import date, datetime, timedelta
+from typing import Callable
+
+BACKFILL_DB='aki_backfill.sqlite'
+KIND='backfill'
+
+logger=logging.getLogger(__name__)
+
+#%% helper functions
+def _check_range(conn: sqlite3.Connection, start: date, end: date):
+  '''Records the range of a new backfill, or checks that a resumed one is the same'''
+  stored=state_store.get_meta(conn,'backfill_range')
+  requested=f'{start.isoformat()}/{end.isoformat()}'
+  if stored is None:
+    state_store.set_meta(conn,'backfill_range',requested)
+  elif stored!=requested:
+    raise ValueError(f'state store {stored} belongs to another backfill than {requested}; use a new --state-db')
+
+def backfill(start: date, end: date, state_db: str=BACKFILL_DB, root: str=snapshots.SNAPSHOT_ROOT, chunk_days: int=1,
+  evict_days: float=None, fetch: Callable[[datetime,datetime],pd.DataFrame]=queries.main_range, hours: float=state_store.WINDOW_HOURS)->list[date]:
+  '''Stages results performed in [start, end), returns days written
+
+  evict_days drops encounters idle that long from the state store to bound its size; leave it
+  unset for results identical to a single run, since an evicted encounter that resumes starts over.
+  hours is the two day baseline window; a resumed backfill must use the one it started with.
+  '''
+  conn=state_store.connect(state_db)
+  try:
+    _check_range(conn,start,end)
+    done=state_store.get_meta(conn,'backfill_through')
+    chunk_start=date.fromisoformat(done) if done else start
+    if done:
+      logger.info('resuming backfill at %s',chunk_start)
+    written=[]
+    while chunk_start<end:
+      chunk_end=min(chunk_start+timedelta(days=chunk_days),end)
+      with metrics.stage('backfill_chunk') as stage:
+        raw=fetch(datetime.combine(chunk_start,datetime.min.time()),datetime.combine(chunk_end,datetime.min.time()))
+        df=analytics.stage_with_state(raw,conn,commit=False,hours=hours)
+        for day,part in df.groupby(df['PERFORMED_DT_TM'].dt.date,sort=True):
+          snapshots.write_snapshot(part.reset_index(drop=True),KIND,day,root)
+          written.append(day)
+        state_store.set_meta(conn,'backfill_through',chunk_end.isoformat(),commit=False)
+        if evict_days is not None:
+          state_store.evict(conn,datetime.combine(chunk_end,datetime.min.time())-timedelta(days=evict_days)) # commits
+        conn.commit() # state and checkpoint together, after the partitions are on disk
+        stage['rows']=len(df)
+      logger.info('backfilled %s to %s: %s results',chunk_start,chunk_end,len(df))
+      chunk_start=chunk_end
+    finalize(start,end,conn,root)
+    return(written)
+  finally:
+    conn.close()
+
+def finalize(start: date, end: date, conn: sqlite3.Connection, root: str=snapshots.SNAPSHOT_ROOT):
+  '''Adds aki_encounter to every backfill partition in [start, end)
+
+  The encounters with any aki sample are collected from just two columns of every partition,
+  then each partition is rewritten in turn, so memory stays bounded by one day of results.
+  '''
+  days=[d for d in snapshots.list_partitions(KIND,root) if start<=d<end]
+  done=state_store.get_meta(conn,'backfill_finalized_through')
+  with metrics.stage('backfill_finalize',len(days)):
+    aki_ids=set()
+    for day in days:
+      part=snapshots.read_snapshot(KIND,day,day,columns=['ENCNTR_ID','aki_sample'],root=root)
+      aki_ids.update(part.loc[part['aki_sample'].notna(),'ENCNTR_ID'].dropna().tolist())
+    for day in days:
+      if done and day<=date.fromisoformat(done):
+        continue
+      part=snapshots.read_snapshot(KIND,day,day,root=root)
+      part['aki_encounter']=part['ENCNTR_ID'].isin(aki_ids)
+      snapshots.write_snapshot(part,KIND,day,root)
+      state_store.set_meta(conn,'backfill_finalized_through',day.isoformat())
+
+if __name__=='__main__':
+  logging.basicConfig(level=logging.INFO,format='%(asctime)s %(name)s %(levelname)s %(message)s')
+  parser=argparse.ArgumentParser(description='Replay KDIGO staging over historical Cr results in bounded memory')
+  parser.add_argument('start',type=date.fromisoformat,help='first performed date, YYYY-MM-DD')
+  parser.add_argument('end',type=date.fromisoformat,help='day after the last performed date, YYYY-MM-DD')
+  parser.add_argument('--state-db',default=BACKFILL_DB,help='state store and checkpoint of this backfill, reused to resume')
+  parser.add_argument('--root',default=snapshots.SNAPSHOT_ROOT,help='snapshot root the daily partitions are written under')
+  parser.add_argument('--chunk-days',type=int,default=1,help='performed days fetched and staged at a time')
+  parser.add_argument('--evict-days',type=float,default=None,help='drop encounters idle this many days from the state store')
+  parser.add_argument('--twoday-hours',type=float,default=state_store.WINDOW_HOURS,help='window of the two day baseline, AKI_TWODAY_HOURS by default')
+  args=parser.parse_args()
+  days=backfill(args.start,args.end,args.state_db,args.root,args.chunk_days,args.evict_days,hours=args.twoday_hours)
+  print(f'{len(days)} daily partitions written under {args.root}/{KIND}')
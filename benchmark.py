@@ -0,0 +1,162 @@
+'''
+benchmark.py
+
+Purpose: Times each analytics step and the dashboard table builders on synthetic LIS data (synthetic.py), without a live LIS
+
+Each timed stage is written as one JSON line: stage, rows in, best and median seconds over the repeats, rows per second,
+plus the run's environment, so results can be appended to a file and compared across commits for regressions and capacity planning.
+
+Functions:
+
+  time_stage(fn: Callable[[], Any], repeat: int)->tuple[list[float],Any]: Returns wall times of repeat calls of fn and the last result
+  bench_analytics(raw: pd.DataFrame, repeat: int)->tuple[list[dict],pd.DataFrame]: Returns timings of clean_data, each baseline step, KDIGO staging and aki encounters, and the analyzed frame
+  load_dashboard(workdir: str)->module: Returns aki-dash.py loaded against a small local SQLite fixture
+  bench_dashboard(dash_module, analyzed: pd.DataFrame, repeat: int, n_mrns: int=100)->Iterator[dict]: Yields timings of make_maintable, its serialization and make_spectable
+  main(sizes: list[int], repeat: int=3, seed: int=0, dashboard: bool=True)->Iterator[dict]: Yields timings for every stage at every size
+
+Usage:
+
+  python benchmark.py --sizes 10000 100000 1000000 --output bench.jsonl
+
+'''
+
+#%% imports
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import subprocess
+import argparse
+import tempfile
+import importlib.util
+import statistics
+import numpy as np
+import pandas as pd
+import analytics
+import synthetic
+from datetime import datetime
+from typing import Any, Callable, Iterator
+
+SIZES=[10_000,100_000,1_000_000]
+REPO_DIR=os.path.dirname(os.path.abspath(__file__))
+
+#%% helper functions
+def time_stage(fn: Callable[[], Any], repeat: int)->tuple[list[float],Any]:
+  '''Returns wall times of repeat calls of fn and the last result'''
+  times=[]
+  for _ in range(repeat):
+    start=time.perf_counter()
+    result=fn()
+    times.append(time.perf_counter()-start)
+  return(times,result)
+
+def _record(stage: str, rows: int, times: list[float], **extra)->dict:
+  return({'stage':stage,'rows':rows,'repeat':len(times),
+    'seconds_min':min(times),'seconds_median':statistics.median(times),
+    'rows_per_s':rows/min(times) if min(times)>0 else None,**extra})
+
+def bench_analytics(raw: pd.DataFrame, repeat: int)->tuple[list[dict],pd.DataFrame]:
+  '''Returns timings of clean_data, each baseline step, KDIGO staging and aki encounters, and the analyzed frame'''
+  times,df=time_stage(lambda: analytics.clean_data(raw),repeat)
+  records=[_record('clean_data',len(raw),times)]
+  steps=[
+    ('encounter_baseline',lambda: analytics.calc_encounter_baselines(df)),
+    ('twoday_baseline',lambda: analytics.calc_twoday_baselines(df)),
+    ('mdrd_baseline',lambda: analytics.calc_mdrd_baselines(df)),
+    ('aki_sample',lambda: analytics.classify_kdigo(df['RESULT_VAL'],df['OUTPATIENT_BASELINE'],df['encounter_baseline'],
+      df['twoday_baseline'],df['mdrd_baseline'])),
+    ('aki_encounter',lambda: analytics.calc_aki_encounters(df)),
+  ]
+  stage_names={'encounter_baseline':'calc_encounter_baselines','twoday_baseline':'calc_twoday_baselines',
+    'mdrd_baseline':'calc_mdrd_baselines','aki_sample':'classify_kdigo','aki_encounter':'calc_aki_encounters'}
+  for col,fn in steps:
+    times,df[col]=time_stage(fn,repeat)
+    records.append(_record(stage_names[col],len(df),times))
+  times,_=time_stage(lambda: analytics.main(raw.copy()),repeat)
+  records.append(_record('main',len(raw),times))
+  return(records,df)
+
+def load_dashboard(workdir: str):
+  '''Returns aki-dash.py loaded against a small local SQLite fixture
+
+  The dashboard queries, analyzes and indexes data when imported, so it is pointed at a
+  throwaway fixture, snapshot root and inventory, and the scheduled refresh is disabled.
+  '''
+  fixture=os.path.join(workdir,'lis_fixture.sqlite')
+  import backends
+  backends.load_fixture(synthetic.make_lis_frame(1000),fixture)
+  os.environ.update(AKI_DB_BACKEND='sqlite',AKI_SQLITE_PATH=fixture,AKI_COLD_START='query',AKI_REFRESH_MINUTES='0',
+    AKI_SNAPSHOT_ROOT=os.path.join(workdir,'snapshots'),AKI_INVENTORY_DB=os.path.join(workdir,'inventory.sqlite'))
+  sys.modules.setdefault('aki_analysis',analytics) # the name aki-dash.py imports analytics under
+  cwd=os.getcwd()
+  os.chdir(REPO_DIR) # users.txt is read relative to the working directory
+  try:
+    spec=importlib.util.spec_from_file_location('aki_dash',os.path.join(REPO_DIR,'aki-dash.py'))
+    dash_module=importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(dash_module)
+  finally:
+    os.chdir(cwd)
+  return(dash_module)
+
+def bench_dashboard(dash_module, analyzed: pd.DataFrame, repeat: int, n_mrns: int=100)->Iterator[dict]:
+  '''Yields timings of make_maintable, its serialization and make_spectable, the latter per MRN over a sample of n_mrns'''
+  import encounter_index
+  import datatable_query
+  times,main_table=time_stage(lambda: dash_module.make_maintable(analyzed),repeat)
+  patients=analyzed['EPIC_MRN'].nunique()
+  if len(main_table)<max(1,patients//100):
+    raise ValueError(f'main table has {len(main_table)} rows for {patients} patients; synthetic data has too few new aki results to time it')
+  yield(_record('make_maintable',len(analyzed),times,table_rows=len(main_table)))
+  times,_=time_stage(lambda: datatable_query.prepare_table(main_table),repeat)
+  yield(_record('prepare_table',len(main_table),times))
+  times,index=time_stage(lambda: encounter_index.build_index(analyzed),repeat)
+  yield(_record('build_index',len(analyzed),times))
+  mrns=pd.Series(analyzed['EPIC_MRN'].dropna().unique()).astype(str)
+  mrns=mrns.sample(min(n_mrns,len(mrns)),random_state=0).tolist()
+  times,_=time_stage(lambda: [dash_module.make_spectable(index,[mrn]) for mrn in mrns],repeat)
+  yield(_record('make_spectable',len(analyzed),[t/len(mrns) for t in times],per='mrn',n_mrns=len(mrns)))
+
+def _commit()->str:
+  try:
+    return(subprocess.run(['git','rev-parse','--short','HEAD'],cwd=REPO_DIR,capture_output=True,text=True,check=True).stdout.strip())
+  except (OSError,subprocess.CalledProcessError):
+    return(None)
+
+def _environment()->dict:
+  return({'timestamp':datetime.now().isoformat(timespec='seconds'),'commit':_commit(),'host':socket.gethostname(),
+    'python':platform.python_version(),'pandas':pd.__version__,'numpy':np.__version__,'cpus':os.cpu_count()})
+
+def main(sizes: list[int], repeat: int=3, seed: int=0, dashboard: bool=True)->Iterator[dict]:
+  '''Yields timings for every stage at every size'''
+  env=_environment()
+  with tempfile.TemporaryDirectory() as workdir:
+    dash_module=load_dashboard(workdir) if dashboard else None
+    for size in sizes:
+      start=time.perf_counter()
+      raw=synthetic.make_lis_frame(size,seed)
+      yield({**_record('make_lis_frame',len(raw),[time.perf_counter()-start]),'size':size,**env})
+      records,analyzed=bench_analytics(raw,repeat)
+      for record in records:
+        yield({**record,'size':size,**env})
+      if dash_module is not None:
+        for record in bench_dashboard(dash_module,analyzed,repeat):
+          yield({**record,'size':size,**env})
+
+if __name__=='__main__':
+  parser=argparse.ArgumentParser(description='Benchmark analytics and dashboard table builders on synthetic LIS data')
+  parser.add_argument('--sizes',type=int,nargs='+',default=SIZES,help='approximate rows of synthetic data per run')
+  parser.add_argument('--repeat',type=int,default=3,help='timed calls per stage; min and median are reported')
+  parser.add_argument('--seed',type=int,default=0)
+  parser.add_argument('--no-dashboard',action='store_true',help='skip make_maintable and make_spectable')
+  parser.add_argument('--output',help='append JSON lines to this file instead of printing them')
+  args=parser.parse_args()
+  out=open(args.output,'a') if args.output else sys.stdout
+  try:
+    for record in main(args.sizes,args.repeat,args.seed,not args.no_dashboard):
+      out.write(json.dumps(record)+'\n')
+      out.flush()
+  finally:
+    if out is not sys.stdout:
+      out.close()
@@ -0,0 +1,169 @@
+'''
+datatable_query.py
+
+Purpose: Server side filtering, sorting and paging of pandas frames for Dash DataTables in custom mode
+
+Classes:
+
+  PreparedTable(frame, records, payload): A display ready table with its records built and serialized once
+
+Functions:
+
+  split_filter_part(filter_part: str)->tuple: Returns (column, operator, value, case_sensitive) of one clause of a DataTable filter_query
+  apply_filter(df: pd.DataFrame, filter_query: str)->pd.DataFrame: Returns rows matching every clause of filter_query
+  apply_sort(df: pd.DataFrame, sort_by: list[dict])->pd.DataFrame: Returns rows ordered by the DataTable sort_by spec
+  query_page(df: pd.DataFrame, page_current: int, page_size: int, sort_by: list[dict]=None, filter_query: str='')->tuple[list[dict],int]: Returns records of the requested page and the page count
+  selected_rows(records: list[dict], selected_ids: list)->list[int]: Returns positions of the records whose id is selected
+  merge_selection(selected_ids: list, records: list[dict], page_selected_ids: list)->list: Returns the table's selected ids with this page's checks applied
+  to_records(df: pd.DataFrame)->list[dict]: Returns rows as JSON ready dicts, missing values as None
+  dumps(records: list[dict])->bytes: Returns records serialized as JSON, with orjson when it is installed
+  prepare_table(df: pd.DataFrame)->PreparedTable: Returns df with its records built and serialized
+  query_prepared(table: PreparedTable, page_current: int, page_size: int, sort_by: list[dict]=None, filter_query: str='')->tuple[list[dict],int]: Returns records of the requested page and the page count, from the prepared records when unfiltered and unsorted
+
+'''
+
+#%% imports
+import re
+import math
+import json
+import pandas as pd
+from typing import NamedTuple
+
+try:
+  import orjson # optional, several times faster than json
+except ImportError:
+  orjson=None
+
+FILTER_CLAUSE=re.compile(r'^\s*\{(.+?)\}\s+(is\s+\S+|\S+)\s*(.*?)\s*$') # {column} operator value
+OPERATORS={'=':'eq','eq':'eq','!=':'ne','ne':'ne','<':'lt','lt':'lt','<=':'le','le':'le','>':'gt','gt':'gt','>=':'ge','ge':'ge',
+  'contains':'contains','datestartswith':'datestartswith'} # each may carry an s (case sensitive) or i (insensitive) prefix
+UNARY_OPERATORS=['is blank','is nil','is num','is str']
+
+class PreparedTable(NamedTuple):
+  frame: pd.DataFrame # for filtering and sorting
+  records: list[dict] # frame in its own order
+  payload: bytes # records as JSON
+
+#%% helper functions
+def split_filter_part(filter_part: str)->tuple:
+  '''Returns (column, operator, value, case_sensitive) of one clause of a DataTable filter_query
+
+  The clause is read as {column} operator value, so operator names inside the value are not
+  mistaken for the operator. Values are returned as typed, unquoted, and compared by the column's
+  type in apply_filter. The operator is None if it is not one DataTable filters produce.
+  '''
+  match=FILTER_CLAUSE.match(filter_part)
+  if match is None:
+    return((None,None,None,True))
+  name,operator,value_part=match.groups()
+  operator=' '.join(operator.split())
+  if operator in UNARY_OPERATORS:
+    return(name,operator,None,True)
+  case_sensitive=True # the DataTable default
+  if operator not in OPERATORS and operator[:1] in ('s','i') and operator[1:] in OPERATORS:
+    case_sensitive,operator=operator[0]=='s',operator[1:]
+  v0=value_part[:1]
+  if v0 and v0==value_part[-1] and v0 in ("'",'"','`') and len(value_part)>1:
+    value_part=value_part[1:-1].replace('\\'+v0,v0)
+  return(name,OPERATORS.get(operator),value_part,case_sensitive)
+
+def _comparable(column: pd.Series, value: str, case_sensitive: bool=True, text: bool=False)->tuple:
+  '''Returns column and value in a form that compares like the browser does, as text if asked, value None if it cannot match the column'''
+  if not text and pd.api.types.is_numeric_dtype(column) and not pd.api.types.is_bool_dtype(column):
+    try:
+      return(column,float(value))
+    except ValueError: # e.g. text typed into a numeric column
+      return(column,None)
+  column=column.astype(object)
+  column=column.where(column.isna(),column.astype(str)) # e.g. an MRN keeps its leading zeros
+  if not case_sensitive:
+    return(column.str.lower(),value.lower())
+  return(column,value)
+
+def apply_filter(df: pd.DataFrame, filter_query: str)->pd.DataFrame:
+  '''Returns rows matching every clause of filter_query; a clause with an operator that is not supported matches no rows'''
+  for filter_part in (filter_query or '').split(' && '):
+    if not filter_part.strip():
+      continue
+    col,operator,value,case_sensitive=split_filter_part(filter_part)
+    if col not in df:
+      continue
+    column=df[col]
+    if operator in ('is blank','is nil'):
+      mask=column.isna()|(column.astype(object)=='') if operator=='is blank' else column.isna()
+    elif operator in ('is num','is str'):
+      mask=column.notna()&(pd.api.types.is_numeric_dtype(column)==(operator=='is num'))
+    elif operator is None:
+      mask=pd.Series(False,index=df.index)
+    else:
+      column,value=_comparable(column,value,case_sensitive,text=operator in ('contains','datestartswith'))
+      if value is None:
+        mask=pd.Series(False,index=df.index)
+      elif operator=='contains':
+        mask=column.str.contains(value,regex=False)
+      elif operator=='datestartswith':
+        mask=column.str.startswith(value)
+      else:
+        mask=getattr(column,operator)(value)
+    df=df.loc[mask.fillna(False).astype(bool)]
+  return(df)
+
+def apply_sort(df: pd.DataFrame, sort_by: list[dict])->pd.DataFrame:
+  '''Returns rows ordered by the DataTable sort_by spec'''
+  sort_by=[s for s in (sort_by or []) if s['column_id'] in df]
+  if not sort_by:
+    return(df)
+  return(df.sort_values(by=[s['column_id'] for s in sort_by],
+    ascending=[s['direction']=='asc' for s in sort_by],
+    kind='stable',na_position='last'))
+
+def query_page(df: pd.DataFrame, page_current: int, page_size: int, sort_by: list[dict]=None, filter_query: str='')->tuple[list[dict],int]:
+  '''Returns records of the requested page and the page count'''
+  dff=apply_sort(apply_filter(df,filter_query),sort_by)
+  page_count=max(1,math.ceil(len(dff)/page_size))
+  page_current=min(page_current or 0,page_count-1)
+  return(dff.iloc[page_current*page_size:(page_current+1)*page_size].to_dict('records'),page_count)
+
+def selected_rows(records: list[dict], selected_ids: list)->list[int]:
+  '''Returns positions of the records whose id is selected
+
+  In custom mode selected_rows index into the current page, so they are rebuilt after each page,
+  sort or filter change from the ids selected anywhere in the table (see merge_selection).
+  '''
+  selected=set(selected_ids or [])
+  return([i for i,record in enumerate(records) if record.get('id') in selected])
+
+def merge_selection(selected_ids: list, records: list[dict], page_selected_ids: list)->list:
+  '''Returns the table's selected ids with this page's checks applied, keeping those selected on other pages'''
+  page=set(record.get('id') for record in records or [])
+  checked=list(page_selected_ids or [])
+  kept=[i for i in selected_ids or [] if i not in page]
+  return(kept+[i for i in checked if i not in set(kept)])
+
+def to_records(df: pd.DataFrame)->list[dict]:
+  '''Returns rows as JSON ready dicts, missing values as None
+
+  Built column by column, which is several times faster than to_dict('records') on wide tables.
+  '''
+  names=df.columns.tolist()
+  columns=[df[col].astype(object).where(df[col].notna(),None).tolist() for col in names]
+  return([dict(zip(names,row)) for row in zip(*columns)])
+
+def dumps(records: list[dict])->bytes:
+  '''Returns records serialized as JSON, with orjson when it is installed'''
+  if orjson is not None:
+    return(orjson.dumps(records))
+  return(json.dumps(records,separators=(',',':')).encode())
+
+def prepare_table(df: pd.DataFrame)->PreparedTable:
+  '''Returns df with its records built and serialized, e.g. once per data version'''
+  records=to_records(df)
+  return(PreparedTable(df,records,dumps(records)))
+
+def query_prepared(table: PreparedTable, page_current: int, page_size: int, sort_by: list[dict]=None, filter_query: str='')->tuple[list[dict],int]:
+  '''Returns records of the requested page and the page count, from the prepared records when unfiltered and unsorted'''
+  if (filter_query or '').strip() or sort_by:
+    return(query_page(table.frame,page_current,page_size,sort_by,filter_query))
+  page_count=max(1,math.ceil(len(table.records)/page_size))
+  page_current=min(page_current or 0,page_count-1)
+  return(table.records[page_current*page_size:(page_current+1)*page_size],page_count)
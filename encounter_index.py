@@ -0,0 +1,56 @@
+'''
+encounter_index.py
+
+Purpose: Sorted row index over analyzed aki-reporter data so patient and encounter lookups slice contiguous rows instead of scanning the frame
+
+Functions:
+
+  build_index(df: pd.DataFrame)->EncounterIndex: Returns data sorted by MRN, encounter and performed time with the row range of every MRN and encounter
+  key_ranges(keys: pd.Series)->dict: Returns {key: (start, stop)} for each run of equal keys in a sorted column
+  rows_for(index: EncounterIndex, key: str, values: list)->pd.DataFrame: Returns the rows for the given MRNs or encounters
+
+'''
+
+#%% imports
+from typing import NamedTuple
+import pandas as pd
+import numpy as np
+
+INDEX_KEYS=['EPIC_MRN','ENCNTR_ID','PERFORMED_DT_TM']
+
+class EncounterIndex(NamedTuple):
+  frame: pd.DataFrame # analyzed data sorted by INDEX_KEYS
+  ranges: dict # {'EPIC_MRN': {mrn: (start, stop)}, 'ENCNTR_ID': {encntr_id: (start, stop)}}
+
+#%% helper functions
+def key_ranges(keys: pd.Series)->dict:
+  '''Returns {key: (start, stop)} for each run of equal keys in a sorted column'''
+  vals=keys.to_numpy()
+  if len(vals)==0:
+    return({})
+  isna=pd.isna(keys).to_numpy()
+  changed=np.ones(len(vals),dtype=bool)
+  changed[1:]=(vals[1:]!=vals[:-1])&~(isna[1:]&isna[:-1])
+  starts=np.flatnonzero(changed)
+  stops=np.append(starts[1:],len(vals))
+  keep=~isna[starts] # nan keys are never looked up
+  return(dict(zip(vals[starts[keep]].tolist(),zip(starts[keep].tolist(),stops[keep].tolist()))))
+
+def build_index(df: pd.DataFrame)->EncounterIndex:
+  '''Returns data sorted by MRN, encounter and performed time with the row range of every MRN and encounter
+
+  A frame marked df.attrs['sorted_by']==INDEX_KEYS is used as is, e.g. a memory mapped shared
+  dataset (shared_data.py) that sorting would copy into every worker.
+  '''
+  frame=df if df.attrs.get('sorted_by')==INDEX_KEYS else df.sort_values(by=INDEX_KEYS,kind='stable',na_position='last',ignore_index=True)
+  ranges={'EPIC_MRN':key_ranges(frame['EPIC_MRN']),
+    'ENCNTR_ID':key_ranges(frame['ENCNTR_ID'])} # an encounter belongs to one MRN so its rows are contiguous too
+  return(EncounterIndex(frame,ranges))
+
+def rows_for(index: EncounterIndex, key: str, values: list)->pd.DataFrame:
+  '''Returns the rows for the given MRNs or encounters'''
+  spans=[index.ranges[key][v] for v in (values or []) if v in index.ranges[key]]
+  if not spans:
+    return(index.frame.iloc[0:0])
+  positions=np.concatenate([np.arange(start,stop) for start,stop in spans])
+  return(index.frame.iloc[positions])
@@ -0,0 +1,107 @@
+'''
+inventory_store.py
+
+Purpose: Shared, persistent inventory of specimen to capture, kept in a local SQLite file so it survives page reloads and is seen by every technologist
+
+Tables:
+
+  events: append-only log of inventory adds and removes keyed by accession, with who and when; a specimen is inventoried if its latest event is an add
+
+Functions:
+
+  connect(path: str=INVENTORY_DB)->sqlite3.Connection: Returns connection to the inventory store, creating tables if needed
+  add(conn, records: list[dict], user: str=None)->int: Adds specimen records not already inventoried, returns number added
+  remove(conn, accessions: list[str], user: str=None)->int: Removes inventoried accessions, returns number removed
+  load(conn)->pd.DataFrame: Returns current inventory, oldest first
+  iter_csv(conn, batch_size: int=500)->Iterator[str]: Yields current inventory as csv text, a batch of rows at a time
+
+'''
+
+#%% imports
+import os
+import csv
+import io
+import json
+import sqlite3
+import pandas as pd
+from datetime import datetime
+from typing import Iterator
+
+INVENTORY_DB=os.environ.get('AKI_INVENTORY_DB','aki_inventory.sqlite')
+INVENTORY_COLS=['Acc #','MRN','NAME','DOB','Drawn DTTM','Received DTTM','Cr','OP Base','KDIGO','Tube']
+CURRENT_SQL='''
+  SELECT accession,record,at,user FROM events e
+  WHERE action='add' AND seq=(SELECT MAX(seq) FROM events WHERE accession=e.accession)
+  ORDER BY seq'''
+
+#%% helper functions
+def connect(path: str=INVENTORY_DB)->sqlite3.Connection:
+  '''Returns connection to the inventory store, creating tables if needed'''
+  conn=sqlite3.connect(path,timeout=30) # several dashboard workers may write at once
+  conn.executescript('''
+    CREATE TABLE IF NOT EXISTS events (
+      seq INTEGER PRIMARY KEY AUTOINCREMENT,
+      accession TEXT NOT NULL,
+      action TEXT NOT NULL,
+      at TEXT,
+      user TEXT,
+      record TEXT
+    );
+    CREATE INDEX IF NOT EXISTS events_accession ON events (accession, seq);
+  ''')
+  return(conn)
+
+def _inventoried(conn: sqlite3.Connection, accessions: list[str])->set:
+  '''Returns the subset of accessions currently inventoried'''
+  found=set()
+  for i in range(0,len(accessions),500):
+    batch=accessions[i:i+500]
+    found|={r[0] for r in conn.execute('''SELECT accession FROM events e WHERE accession IN (%s) AND action='add'
+      AND seq=(SELECT MAX(seq) FROM events WHERE accession=e.accession)'''%','.join('?'*len(batch)),batch)}
+  return(found)
+
+def _csv_value(value):
+  return('' if value is None or value!=value else value) # blank, not 'nan', for missing values
+
+def _append(conn: sqlite3.Connection, rows: list[tuple]):
+  conn.executemany('INSERT INTO events (accession,action,at,user,record) VALUES (?,?,?,?,?)',rows)
+  conn.commit()
+
+def add(conn: sqlite3.Connection, records: list[dict], user: str=None)->int:
+  '''Adds specimen records not already inventoried, returns number added'''
+  records={str(r['Acc #']):r for r in records} # one event per accession
+  held=_inventoried(conn,list(records))
+  new=[a for a in records if a not in held]
+  at=datetime.now().isoformat(sep=' ',timespec='seconds')
+  _append(conn,[(a,'add',at,user,json.dumps({c:records[a].get(c) for c in INVENTORY_COLS})) for a in new])
+  return(len(new))
+
+def remove(conn: sqlite3.Connection, accessions: list[str], user: str=None)->int:
+  '''Removes inventoried accessions, returns number removed'''
+  held=_inventoried(conn,[str(a) for a in accessions])
+  at=datetime.now().isoformat(sep=' ',timespec='seconds')
+  _append(conn,[(a,'remove',at,user,None) for a in held])
+  return(len(held))
+
+def load(conn: sqlite3.Connection)->pd.DataFrame:
+  '''Returns current inventory, oldest first'''
+  inventory=pd.DataFrame([json.loads(record) for _,record,_,_ in conn.execute(CURRENT_SQL)],columns=INVENTORY_COLS)
+  inventory['id']=inventory['Acc #']
+  return(inventory)
+
+def iter_csv(conn: sqlite3.Connection, batch_size: int=500)->Iterator[str]:
+  '''Yields current inventory as csv text, a batch of rows at a time'''
+  buffer=io.StringIO()
+  writer=csv.writer(buffer)
+  writer.writerow(INVENTORY_COLS+['Added DTTM','Added By'])
+  cur=conn.execute(CURRENT_SQL)
+  while True:
+    rows=cur.fetchmany(batch_size)
+    for _,record,at,user in rows:
+      record=json.loads(record)
+      writer.writerow([_csv_value(record.get(c)) for c in INVENTORY_COLS]+[at,user])
+    yield(buffer.getvalue())
+    buffer.seek(0)
+    buffer.truncate()
+    if not rows:
+      return
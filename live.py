@@ -0,0 +1,177 @@
+'''
+live.py
+
+Purpose: Near-real-time micro-batches between full refreshes of aki-dash.py
+
+Every few minutes the LIS is polled for results performed after a high-water mark. Only those results are staged,
+with baselines continued from an in-memory state store (see analytics.stage_with_state) that is seeded from each
+snapshot the Refresher publishes, so a cycle costs in proportion to the new results rather than the census. The
+staged rows are kept as a delta on top of that snapshot, which the dashboard merges into its tables; the next full
+refresh folds them in and the delta starts over.
+
+Encounters that were not in the snapshot, e.g. admitted since or with no result in its query window, have their
+earlier results fetched and added to the state store before their first new rows are staged, so their baselines
+match a full run. Results that reach the LIS with a performed time before the high-water mark are only picked up by
+the next full refresh.
+
+Classes:
+
+  LiveFeed(fetch: Callable=queries.main_range, interval_minutes: float=LIVE_MINUTES, outpatient_history: Callable=None,
+    fetch_encounters: Callable=queries.main_encounters, hours: float=state_store.WINDOW_HOURS): Polls for new results and stages them against the current snapshot
+
+'''
+
+#%% imports
+import os
+import logging
+import threading
+import pandas as pd
+import analytics
+import metrics
+import queries
+import state_store
+from datetime import datetime
+from typing import Callable, NamedTuple
+
+LIVE_MINUTES=float(os.environ.get('AKI_LIVE_MINUTES',5)) # 0 disables polling between full refreshes
+
+logger=logging.getLogger(__name__)
+
+#%% classes
+class LiveDelta(NamedTuple):
+  version: int # data version the rows were staged against
+  seq: int # bumped with every batch that added rows
+  polled_at: datetime
+  df: pd.DataFrame # staged rows since that version was published, same columns as analytics.main
+
+class LiveFeed:
+  '''Polls for new results and stages them against the current snapshot
+
+  Register on_publish as a Refresher listener before the first snapshot is published. poll() runs
+  on the feed's own thread, which also owns the in-memory state store; callbacks read delta().
+  '''
+
+  def __init__(self, fetch: Callable[[datetime,datetime],pd.DataFrame]=queries.main_range, interval_minutes: float=LIVE_MINUTES,
+    outpatient_history: Callable[[pd.DataFrame],pd.DataFrame]=None, fetch_encounters: Callable[[list],pd.DataFrame]=queries.main_encounters,
+    hours: float=state_store.WINDOW_HOURS):
+    self.fetch=fetch
+    self.fetch_encounters=fetch_encounters # encounter ids -> all their results, for encounters the state store has not seen
+    self.hours=hours # two day baseline window, the one the snapshots were analyzed with
+    self.interval_minutes=interval_minutes
+    self.outpatient_history=outpatient_history # raw results -> outpatient history of their patients, if baselines are local
+    self._conn=None
+    self._snapshot=None # snapshot the state store was seeded from
+    self._pending=None # snapshot published since, seeded on the next poll
+    self._high_water=None
+    self._seen=set() # accessions performed exactly at the high-water mark, already staged
+    self._history_aki=set() # encounters outside the snapshot whose fetched history has aki samples
+    self._delta=LiveDelta(0,0,None,pd.DataFrame())
+    self._frames=[]
+    self._lock=threading.Lock()
+    self._poll_lock=threading.Lock() # one poll at a time
+    self._stop=threading.Event()
+    self._thread=None
+
+  def on_publish(self, snapshot):
+    '''Starts an empty delta on top of a newly published snapshot'''
+    with self._lock:
+      self._pending=snapshot
+      self._frames=[]
+      self._delta=LiveDelta(snapshot.version,0,None,pd.DataFrame())
+
+  def delta(self)->LiveDelta:
+    '''Returns the rows staged since the current snapshot'''
+    return(self._delta)
+
+  def _seed(self, snapshot):
+    '''Rebuilds the state store and high-water mark from a snapshot's analyzed data'''
+    with metrics.stage('live_seed',len(snapshot.df)):
+      if self._conn is not None:
+        self._conn.close()
+      self._conn=state_store.connect(':memory:')
+      state_store.save_state(self._conn,snapshot.df,self.hours)
+      performed=snapshot.df['PERFORMED_DT_TM'].dropna() if len(snapshot.df) else pd.Series(dtype='datetime64[ns]')
+      self._high_water=performed.max() if len(performed) else pd.Timestamp(snapshot.refreshed_at)
+      self._seen=set(snapshot.df.loc[snapshot.df['PERFORMED_DT_TM']==self._high_water,'ACCESSION'].astype(str))
+      self._history_aki=set()
+      self._snapshot=snapshot
+
+  def _add_history(self, raw: pd.DataFrame):
+    '''Adds the earlier results of encounters new to the state store, so their new rows continue from them'''
+    ids=raw['ENCNTR_ID'].dropna().unique()
+    unseen=sorted(set(float(e) for e in ids)-state_store.known_encounters(self._conn,ids))
+    if not unseen:
+      return
+    with metrics.stage('live_history',len(unseen)) as stage:
+      history=self.fetch_encounters(unseen)
+      history=history.loc[(pd.to_datetime(history['PERFORMED_DT_TM'])<self._high_water)
+        &~history['ACCESSION'].astype(str).isin(raw['ACCESSION'].astype(str))] # later rows are staged by this poll
+      if len(history):
+        outpatient=self.outpatient_history(history) if self.outpatient_history is not None else None
+        history=analytics.stage_with_state(history,self._conn,outpatient_history=outpatient,hours=self.hours)
+        self._history_aki|=set(history.loc[history['aki_sample'].notna(),'ENCNTR_ID'])
+      stage['rows']=len(history)
+
+  def _aki_encounters(self, df: pd.DataFrame)->pd.Series:
+    '''Returns aki_encounter for new rows, counting the snapshot's, fetched history's and earlier batches' rows of the same encounters'''
+    index=self._snapshot.index
+    earlier=[index.frame.iloc[slice(*index.ranges['ENCNTR_ID'][e])] for e in df['ENCNTR_ID'].dropna().unique() if e in index.ranges['ENCNTR_ID']]
+    earlier+=[f.loc[f['ENCNTR_ID'].isin(df['ENCNTR_ID'])] for f in self._frames]
+    cols=['ENCNTR_ID','aki_sample']
+    combined=pd.concat([e[cols] for e in earlier]+[df[cols]],ignore_index=True)
+    return(analytics.calc_aki_encounters(combined).to_numpy()[len(combined)-len(df):]|df['ENCNTR_ID'].isin(self._history_aki).to_numpy())
+
+  def poll(self)->int:
+    '''Fetches and stages results performed since the high-water mark, returns number of rows added to the delta'''
+    with self._poll_lock, metrics.stage('live_poll') as stage:
+      with self._lock:
+        pending,self._pending=self._pending,None
+      if pending is not None:
+        self._seed(pending)
+      if self._snapshot is None:
+        return(0)
+      version=self._snapshot.version
+      polled_at=datetime.now()
+      raw=self.fetch(self._high_water.to_pydatetime(),polled_at) # [high water, now) so late rows at the mark are not lost
+      raw=raw.loc[~((pd.to_datetime(raw['PERFORMED_DT_TM'])==self._high_water)&raw['ACCESSION'].astype(str).isin(self._seen))]
+      if len(raw)==0:
+        with self._lock:
+          if self._delta.version==version:
+            self._delta=self._delta._replace(polled_at=polled_at)
+        stage['rows']=0
+        return(0)
+      self._add_history(raw)
+      history=self.outpatient_history(raw) if self.outpatient_history is not None else None
+      df=analytics.stage_with_state(raw,self._conn,outpatient_history=history,hours=self.hours)
+      df['NEW_RESULT_IND']=1 # performed minutes ago
+      df['aki_encounter']=self._aki_encounters(df)
+      performed=df['PERFORMED_DT_TM'].dropna()
+      if len(performed) and performed.max()>=self._high_water:
+        if performed.max()>self._high_water:
+          self._high_water,self._seen=performed.max(),set()
+        self._seen|=set(df.loc[df['PERFORMED_DT_TM']==self._high_water,'ACCESSION'].astype(str))
+      with self._lock:
+        if self._delta.version!=version: # a full refresh was published meanwhile and covers these rows
+          return(0)
+        self._frames.append(df)
+        self._delta=LiveDelta(version,self._delta.seq+1,polled_at,pd.concat(self._frames,ignore_index=True))
+      stage['rows']=len(df)
+      logger.info('live batch %s on data version %s: %s results, %s aki',self._delta.seq,version,len(df),int(df['aki_sample'].notna().sum()))
+      return(len(df))
+
+  def _run(self):
+    while not self._stop.wait(self.interval_minutes*60):
+      try:
+        self.poll()
+      except Exception:
+        logger.exception('live poll failed, will retry')
+
+  def start(self):
+    '''Starts polling every interval, if one is set'''
+    if self.interval_minutes>0 and self._thread is None:
+      self._thread=threading.Thread(target=self._run,name='aki-live',daemon=True)
+      self._thread.start()
+
+  def stop(self):
+    '''Stops polling'''
+    self._stop.set()
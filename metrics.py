@@ -0,0 +1,204 @@
+'''
+metrics.py
+
+Purpose: Stage timings, row counts and peak memory for the query and analytics pipeline, and latency histograms for dashboard callbacks
+
+Every finished stage is logged as one JSON line on the 'metrics' logger and folded into a process wide registry,
+which instrument_server exposes on the dashboard's Flask server (Prometheus text, or JSON with ?format=json).
+
+Classes:
+
+  Histogram(buckets: tuple=BUCKETS): Cumulative latency histogram with fixed upper bounds in seconds
+  Registry(): Latest stage records and latency histograms, safe to update from several threads
+
+Functions:
+
+  stage(name: str, rows_in: int=None)->ContextManager[dict]: Times the enclosed block as one stage; set record['rows'] inside to report rows out
+  observe(kind: str, name: str, seconds: float): Adds one latency to the histogram for kind and name
+  instrument_server(app, path: str='/metrics'): Times every server side dash callback and serves the registry at path
+
+'''
+
+#%% imports
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterator
+
+try:
+  import resource # not on windows
+except ImportError:
+  resource=None
+
+TRACE_MEMORY=os.environ.get('AKI_TRACE_MEMORY','0')=='1' # python level peak memory per stage, at some cost in speed
+BUCKETS=(0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,120,300,float('inf'))
+
+logger=logging.getLogger(__name__)
+
+#%% classes
+class Histogram:
+  '''Cumulative latency histogram with fixed upper bounds in seconds'''
+
+  def __init__(self, buckets: tuple=BUCKETS):
+    self.buckets=buckets
+    self.counts=[0]*len(buckets)
+    self.count=0
+    self.sum=0.0
+
+  def observe(self, seconds: float):
+    for i,bound in enumerate(self.buckets):
+      if seconds<=bound:
+        self.counts[i]+=1
+        break
+    self.count+=1
+    self.sum+=seconds
+
+  def cumulative(self)->list[tuple[float,int]]:
+    '''Returns (upper bound, observations at or below it) for every bucket'''
+    total,out=0,[]
+    for bound,n in zip(self.buckets,self.counts):
+      total+=n
+      out.append((bound,total))
+    return(out)
+
+class Registry:
+  '''Latest stage records and latency histograms, safe to update from several threads'''
+
+  def __init__(self):
+    self.stages={} # stage name -> latest record
+    self.histograms={} # (kind, name) -> Histogram
+    self._lock=threading.Lock()
+
+  def observe(self, kind: str, name: str, seconds: float):
+    with self._lock:
+      self.histograms.setdefault((kind,name),Histogram()).observe(seconds)
+
+  def record_stage(self, record: dict):
+    with self._lock:
+      self.stages[record['stage']]=record
+      self.histograms.setdefault(('stage',record['stage']),Histogram()).observe(record['seconds'])
+
+  def as_dict(self)->dict:
+    '''Returns the registry as plain JSON serializable values'''
+    with self._lock:
+      return({'stages':dict(self.stages),
+        'histograms':[{'kind':kind,'name':name,'count':h.count,'sum':h.sum,
+          'buckets':[['+Inf' if b==float('inf') else b,n] for b,n in h.cumulative()]}
+          for (kind,name),h in self.histograms.items()]})
+
+  def as_prometheus(self)->str:
+    '''Returns the registry in the Prometheus text exposition format'''
+    lines=[]
+    with self._lock:
+      for kind in sorted({k for k,_ in self.histograms}):
+        metric=f'aki_{kind}_seconds'
+        lines.append(f'# TYPE {metric} histogram')
+        for (k,name),h in self.histograms.items():
+          if k!=kind:
+            continue
+          for bound,n in h.cumulative():
+            le='+Inf' if bound==float('inf') else repr(bound)
+            lines.append(f'{metric}_bucket{{name="{name}",le="{le}"}} {n}')
+          lines.append(f'{metric}_sum{{name="{name}"}} {h.sum}')
+          lines.append(f'{metric}_count{{name="{name}"}} {h.count}')
+      for field in ('seconds','rows','process_rss_peak_mb','rss_peak_growth_mb','mem_peak_mb'):
+        lines.append(f'# TYPE aki_stage_last_{field} gauge')
+        for name,record in self.stages.items():
+          if record.get(field) is not None:
+            lines.append(f'aki_stage_last_{field}{{name="{name}"}} {record[field]}')
+    return('\n'.join(lines)+'\n')
+
+REGISTRY=Registry()
+
+#%% helper functions
+def _rss_peak_mb()->float:
+  '''Returns the process's peak resident memory so far in MB'''
+  if resource is None:
+    return(None)
+  peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return(peak/2**20 if sys.platform=='darwin' else peak/2**10) # bytes on macos, KB on linux
+
+_local=threading.local() # per thread stack of open stages, for nested peak memory
+
+@contextmanager
+def stage(name: str, rows_in: int=None)->Iterator[dict]:
+  '''Times the enclosed block as one stage; set record['rows'] inside to report rows out
+
+  Logs and registers wall time, rows, the process's lifetime peak RSS and how far the stage raised
+  it, and, when AKI_TRACE_MEMORY=1, the peak python level allocation made during the stage
+  (numpy and pandas buffers included). A stage that stays below an earlier peak shows no growth.
+  '''
+  record={'stage':name,'rows_in':rows_in,'rows':None}
+  stack=_local.__dict__.setdefault('stack',[])
+  if TRACE_MEMORY and not tracemalloc.is_tracing():
+    tracemalloc.start()
+  tracing=tracemalloc.is_tracing()
+  if tracing:
+    peak=tracemalloc.get_traced_memory()[1]
+    if stack:
+      stack[-1]['peak']=max(stack[-1]['peak'],peak) # an inner reset must not hide the outer stage's peak
+    tracemalloc.reset_peak()
+  frame={'start_mem':tracemalloc.get_traced_memory()[0] if tracing else 0,'peak':0}
+  stack.append(frame)
+  rss_start=_rss_peak_mb()
+  started=time.perf_counter()
+  try:
+    yield(record)
+  finally:
+    record['seconds']=round(time.perf_counter()-started,6)
+    stack.pop()
+    if tracing:
+      peak=max(tracemalloc.get_traced_memory()[1],frame['peak'])
+      record['mem_peak_mb']=round((peak-frame['start_mem'])/2**20,3)
+      if stack:
+        stack[-1]['peak']=max(stack[-1]['peak'],peak)
+    rss=_rss_peak_mb()
+    record['process_rss_peak_mb']=round(rss,3) if rss is not None else None
+    record['rss_peak_growth_mb']=round(rss-rss_start,3) if rss is not None else None
+    record['finished_at']=datetime.now().isoformat(timespec='seconds')
+    REGISTRY.record_stage(record)
+    logger.info(json.dumps(record))
+
+def observe(kind: str, name: str, seconds: float):
+  '''Adds one latency to the histogram for kind and name'''
+  REGISTRY.observe(kind,name,seconds)
+
+def instrument_server(app, path: str='/metrics'):
+  '''Times every server side dash callback and serves the registry at path
+
+  Callbacks are timed per request to the dash update endpoint, so the latency includes
+  deserializing inputs and serializing outputs, and is labelled with the callback's function name.
+  '''
+  import flask
+  server=app.server
+
+  def callback_name(output: str)->str:
+    entry=app.callback_map.get(output,{})
+    return(getattr(entry.get('callback'),'__name__',output))
+
+  @server.before_request
+  def _start_timer():
+    if flask.request.path.endswith('_dash-update-component'):
+      flask.g.aki_callback_started=time.perf_counter()
+
+  @server.after_request
+  def _stop_timer(response):
+    started=flask.g.pop('aki_callback_started',None)
+    if started is not None:
+      seconds=time.perf_counter()-started
+      name=callback_name((flask.request.get_json(silent=True) or {}).get('output',''))
+      observe('callback',name,seconds)
+      logger.info(json.dumps({'callback':name,'seconds':round(seconds,6),'status':response.status_code}))
+    return(response)
+
+  @server.route(path)
+  def _metrics():
+    if flask.request.args.get('format')=='json':
+      return(flask.jsonify(REGISTRY.as_dict()))
+    return(flask.Response(REGISTRY.as_prometheus(),mimetype='text/plain; version=0.0.4'))
@@ -0,0 +1,145 @@
+'''
+outpatient_store.py
+
+Purpose: Local per-patient history of outpatient Cr results, so the one year outpatient baseline can be computed by
+analytics.calc_outpatient_baselines instead of inside the LIS query
+
+Tables:
+
+  results: outpatient Cr results keyed by accession - patient, performed time (ns) and value
+  meta: key/value pairs, e.g. the performed time high-water mark of the outpatient feed
+
+Classes:
+
+  RollingMedian(): Median of a time ordered stream of results, with expiry of the oldest
+
+Functions:
+
+  connect(path: str=OUTPATIENT_DB)->sqlite3.Connection: Returns connection to the outpatient store, creating tables if needed
+  add_results(conn, df: pd.DataFrame)->int: Stores new outpatient results, ignoring accessions already stored, returns number added
+  expire(conn, before: datetime)->int: Removes results performed before before, returns number removed
+  update(conn, fetch: Callable[[datetime], pd.DataFrame], days: float=WINDOW_DAYS, now: datetime=None)->int: Fetches results since the high-water mark, stores them and expires those older than the window
+  load_history(conn, mrns: list[str])->pd.DataFrame: Returns stored results of these patients ordered by patient and performed time
+
+'''
+
+#%% imports
+import os
+import sqlite3
+import bisect
+import pandas as pd
+import numpy as np
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Callable
+
+OUTPATIENT_DB=os.environ.get('AKI_OUTPATIENT_DB','aki_outpatient.sqlite')
+WINDOW_DAYS=365
+HISTORY_COLS=['EPIC_MRN','PERFORMED_DT_TM','RESULT_VAL']
+
+#%% classes
+class RollingMedian:
+  '''Median of a time ordered stream of results, with expiry of the oldest
+
+  Results are kept twice: in arrival order, to know which to expire, and in a sorted list, so the
+  median is a lookup and each add or expiry is a binary search plus a short shift. A patient has
+  tens of outpatient results a year, so this beats heaps with lazy deletion in practice.
+  '''
+
+  def __init__(self):
+    self._arrivals=deque() # (time, value), oldest first
+    self._sorted=[]
+
+  def __len__(self)->int:
+    return(len(self._sorted))
+
+  def add(self, time: int, value: float):
+    '''Adds a result no older than those already added; nan results are ignored'''
+    if value!=value:
+      return
+    self._arrivals.append((time,value))
+    bisect.insort(self._sorted,value)
+
+  def expire(self, before: int):
+    '''Drops results performed before before'''
+    while self._arrivals and self._arrivals[0][0]<before:
+      _,value=self._arrivals.popleft()
+      del self._sorted[bisect.bisect_left(self._sorted,value)]
+
+  def median(self)->float:
+    '''Returns the median of the current results, nan if there are none'''
+    n=len(self._sorted)
+    if n==0:
+      return(np.nan)
+    mid=n//2
+    return(self._sorted[mid] if n%2 else (self._sorted[mid-1]+self._sorted[mid])/2)
+
+#%% helper functions
+def connect(path: str=OUTPATIENT_DB)->sqlite3.Connection:
+  '''Returns connection to the outpatient store, creating tables if needed'''
+  conn=sqlite3.connect(path)
+  conn.executescript('''
+    CREATE TABLE IF NOT EXISTS results (
+      ACCESSION TEXT PRIMARY KEY,
+      EPIC_MRN TEXT,
+      PERFORMED_DT_TM INTEGER,
+      RESULT_VAL REAL
+    );
+    CREATE INDEX IF NOT EXISTS results_mrn ON results (EPIC_MRN, PERFORMED_DT_TM);
+    CREATE TABLE IF NOT EXISTS meta (
+      key TEXT PRIMARY KEY,
+      value TEXT
+    );
+  ''')
+  return(conn)
+
+def _to_ns(times: pd.Series)->np.ndarray:
+  return(pd.to_datetime(times).to_numpy(dtype='datetime64[ns]').view('i8'))
+
+def add_results(conn: sqlite3.Connection, df: pd.DataFrame)->int:
+  '''Stores new outpatient results, ignoring accessions already stored, returns number added'''
+  df=df.assign(RESULT_VAL=pd.to_numeric(df['RESULT_VAL'],errors='coerce'))
+  df=df.loc[df['EPIC_MRN'].notna()&df['PERFORMED_DT_TM'].notna()&df['RESULT_VAL'].notna()]
+  if len(df)==0:
+    return(0)
+  before=conn.total_changes
+  conn.executemany('INSERT OR IGNORE INTO results (ACCESSION,EPIC_MRN,PERFORMED_DT_TM,RESULT_VAL) VALUES (?,?,?,?)',
+    zip(df['ACCESSION'].astype(str).tolist(),df['EPIC_MRN'].astype(str).tolist(),_to_ns(df['PERFORMED_DT_TM']).tolist(),df['RESULT_VAL'].astype(float).tolist()))
+  added=conn.total_changes-before
+  last=pd.to_datetime(df['PERFORMED_DT_TM']).max()
+  stored=conn.execute("SELECT value FROM meta WHERE key='last_performed'").fetchone()
+  if stored is None or last>pd.Timestamp(stored[0]):
+    conn.execute("INSERT OR REPLACE INTO meta (key,value) VALUES ('last_performed',?)",(last.isoformat(),))
+  conn.commit()
+  return(added)
+
+def expire(conn: sqlite3.Connection, before: datetime)->int:
+  '''Removes results performed before before, returns number removed'''
+  removed=conn.execute('DELETE FROM results WHERE PERFORMED_DT_TM < ?',(int(_to_ns(pd.Series([before]))[0]),)).rowcount
+  conn.commit()
+  return(removed)
+
+def update(conn: sqlite3.Connection, fetch: Callable[[datetime], pd.DataFrame], days: float=WINDOW_DAYS, now: datetime=None)->int:
+  '''Fetches results since the high-water mark, stores them and expires those older than the window, returns number added
+
+  fetch(since) returns outpatient results performed after since, e.g. queries.main_outpatient;
+  the first run fetches the whole window.
+  '''
+  now=now or datetime.now()
+  stored=conn.execute("SELECT value FROM meta WHERE key='last_performed'").fetchone()
+  since=pd.Timestamp(stored[0]).to_pydatetime() if stored else now-timedelta(days=days)
+  added=add_results(conn,fetch(since))
+  expire(conn,now-timedelta(days=days+1)) # a day of slack so rows staged today still see their full year
+  return(added)
+
+def load_history(conn: sqlite3.Connection, mrns: list[str])->pd.DataFrame:
+  '''Returns stored results of these patients ordered by patient and performed time'''
+  mrns=[str(m) for m in mrns]
+  rows=[]
+  for i in range(0,len(mrns),500):
+    batch=mrns[i:i+500]
+    rows+=conn.execute('SELECT EPIC_MRN,PERFORMED_DT_TM,RESULT_VAL FROM results WHERE EPIC_MRN IN (%s)'%','.join('?'*len(batch)),batch).fetchall()
+  history=pd.DataFrame(rows,columns=HISTORY_COLS)
+  history['PERFORMED_DT_TM']=pd.to_datetime(history['PERFORMED_DT_TM'].astype('int64'))
+  history['RESULT_VAL']=history['RESULT_VAL'].astype(float)
+  return(history.sort_values(by=['EPIC_MRN','PERFORMED_DT_TM'],kind='stable',ignore_index=True))
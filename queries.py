@@ -4,50 +4,64 @@ queries.py
 Created by: Mark A. Zaydman
 10.24.2022
 
-Purpose: Code for querying LIS to get creatinine results for aki-reporter
+Purpose: Code for querying LIS to get creatinine results for aki-reporter. Connections come from
+backends.get_backend(): pooled Oracle sessions by default, or a local SQLite fixture with AKI_DB_BACKEND=sqlite.
 
 Functions:
-  query_oracle(sql: str) -> pd.DataFrame
+  query_oracle_chunks(sql: str, params: dict=None, arraysize: int=ARRAYSIZE) -> Iterator[pd.DataFrame]
+  query_oracle(sql: str, params: dict=None) -> pd.DataFrame
   build_query() -> str
+  build_incremental_query() -> str
+  build_range_query() -> str
+  build_outpatient_query() -> str
+  build_history_query() -> str
+  time_bounds(start: datetime, end: datetime, n_parts: int=4) -> list[datetime]
+  partition_query(sql: str, params: dict=None, n_parts: int=4, by: str='encounter', bounds: list=None) -> list[tuple[str,dict]]
+  query_partitions(parts: list[tuple[str,dict]], max_workers: int=MAX_WORKERS) -> pd.DataFrame
+  main_chunks(since: datetime=None, arraysize: int=ARRAYSIZE) -> Iterator[pd.DataFrame]
+  main(since: datetime=None, partitions: int=1, partition_by: str='encounter', bounds: list=None, max_workers: int=MAX_WORKERS) -> pd.DataFrame
+  main_range(start: datetime, end: datetime) -> pd.DataFrame
+  main_outpatient(since: datetime) -> pd.DataFrame
+  main_encounters(encntr_ids: list, batch_size: int=500) -> pd.DataFrame
 
 '''
 
-import cx_Oracle
 import os
+import time
+import logging
 import pandas as pd
+import backends
+import metrics
+from typing import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime,timedelta
 from dateutil.relativedelta import relativedelta
 
-cx_Oracle.init_oracle_client(lib_dir=r'/opt/oracle/instantclient_21_5')
-
-
-def output_type_handler(cursor, name, default_type, size, precision, scale):
-	if default_type == cx_Oracle.CLOB:
-		return cursor.var(cx_Oracle.LONG_STRING, arraysize=cursor.arraysize)
-	if default_type == cx_Oracle.BLOB:
-		return cursor.var(cx_Oracle.LONG_BINARY, arraysize=cursor.arraysize)
-
-
-def query_oracle(sql: str)->pd.DataFrame:
+ARRAYSIZE=int(os.environ.get('ORACLE_ARRAYSIZE',10000)) # rows per round trip and per streamed chunk
+MAX_WORKERS=int(os.environ.get('LIS_MAX_CONCURRENCY',4)) # partition queries in flight at once
+MERGE_ORDER=['ENCNTR_ID','PERFORMED_DT_TM','ACCESSION'] # partition results are merged in this order
+
+logger=logging.getLogger(__name__)
+
+
+def query_oracle_chunks(sql: str, params: dict=None, arraysize: int=ARRAYSIZE)->Iterator[pd.DataFrame]:
+  """Yields results of sql query LIS database as DataFrames of up to arraysize rows"""
+  backend = backends.get_backend()
+  with backend.connection() as conn:
+    cur = conn.cursor()
+    backend.execute(cur,sql,params,arraysize)
+    columns = [x[0] for x in cur.description]
+    rows = cur.fetchmany(arraysize)
+    if not rows:
+      yield(pd.DataFrame(columns=columns))
+    while rows:
+      yield(pd.DataFrame.from_records(rows,columns=columns,coerce_float=True))
+      rows = cur.fetchmany(arraysize)
+    cur.close()
+
+def query_oracle(sql: str, params: dict=None)->pd.DataFrame:
   """Returns results of sql query LIS database"""
-  host_name=os.environ.get('HOST_NAME')
-  port_num=os.environ.get('PORT_NUM')
-  service_name=os.environ.get('SERVICE_NAME')
-  user_name=os.environ.get('USER_NAME')
-  password=os.environ.get('PASSWORD')
-
-
-  dsn_tns = cx_Oracle.makedsn(host_name, port_num, service_name=service_name) 
-  conn = cx_Oracle.connect(user=user_name, password=password, dsn=dsn_tns) 
-  conn.outputtypehandler = output_type_handler
-
-  # conn = cx_Oracle.connect(user=os.environ.get('ORACLE_DB_USER'), password=os.environ.get('ORACLE_DB_PASS'), dsn=os.environ.get('ORACLE_DB_DSN'))
-  cur = conn.cursor()
-  cur.execute(sql)
-  df = pd.DataFrame(cur.fetchall())
-  df.columns = [x[0] for x in cur.description]
-  cur.close()
-  conn.close()
+  df = pd.concat(query_oracle_chunks(sql,params),ignore_index=True)
   return(df)
 
 def build_query()->str:
@@ -58,12 +72,139 @@ def build_query()->str:
   sql=sql.replace('\n',' ').replace('\t','')
   return(sql)
 
-def main()->pd.DataFrame:
-  """Builds, submits, and returns results of sql query"""
-  sql=build_query()
-  df=query_oracle(sql)
+def build_incremental_query()->str:
+  """Returns sql query for cr results performed at or after :since plus outpatient baseline, same columns as build_query"""
+  sql="""
+    USER DEFINED SQL QUERY GOES HERE, RESTRICTED TO PERFORMED_DT_TM >= :since...
+    """ 
+  sql=sql.replace('\n',' ').replace('\t','')
+  return(sql)
+
+def build_outpatient_query()->str:
+  """Returns sql query for outpatient cr results performed after :since - ACCESSION, EPIC_MRN, PERFORMED_DT_TM, RESULT_VAL - for outpatient_store.py"""
+  sql="""
+    USER DEFINED SQL QUERY GOES HERE, OUTPATIENT CR RESULTS WITH PERFORMED_DT_TM > :since...
+    """ 
+  sql=sql.replace('\n',' ').replace('\t','')
+  return(sql)
+
+def build_history_query()->str:
+  """Returns sql query for all cr results plus outpatient baseline without a time restriction, same columns as build_query; main_encounters restricts it to given encounters"""
+  sql="""
+    USER DEFINED SQL QUERY GOES HERE, ALL CR RESULTS WITHOUT A PERFORMED TIME RESTRICTION...
+    """ 
+  sql=sql.replace('\n',' ').replace('\t','')
+  return(sql)
+
+def build_range_query()->str:
+  """Returns sql query for all cr results performed in [:start, :end) plus outpatient baseline, same columns as build_query"""
+  sql="""
+    USER DEFINED SQL QUERY GOES HERE, RESTRICTED TO PERFORMED_DT_TM >= :start AND PERFORMED_DT_TM < :end...
+    """ 
+  sql=sql.replace('\n',' ').replace('\t','')
+  return(sql)
+
+def time_bounds(start: datetime, end: datetime, n_parts: int=4)->list[datetime]:
+  """Returns n_parts-1 times splitting [start, end) evenly, computed locally so the LIS runs no extra query"""
+  return([start+(end-start)*i/n_parts for i in range(1,n_parts)])
+
+def partition_query(sql: str, params: dict=None, n_parts: int=4, by: str='encounter', bounds: list=None)->list[tuple[str,dict]]:
+  """Returns (sql, params) for each partition of sql, split by ENCNTR_ID modulo n_parts or by PERFORMED_DT_TM at the given bounds"""
+  params=params or {}
+  if by=='encounter':
+    mod=backends.get_backend().mod_sql.format(col='ENCNTR_ID')
+    parts=[(f'SELECT * FROM ({sql}) WHERE {mod} = :part'+(' OR ENCNTR_ID IS NULL' if i==0 else ''),{**params,'n_parts':n_parts,'part':i})
+      for i in range(n_parts)]
+  elif by=='time':
+    bounds=sorted(bounds) # first and last slices are open ended so no row is lost
+    parts=[(f'SELECT * FROM ({sql}) WHERE PERFORMED_DT_TM < :part_end OR PERFORMED_DT_TM IS NULL',{**params,'part_end':bounds[0]})]
+    parts+=[(f'SELECT * FROM ({sql}) WHERE PERFORMED_DT_TM >= :part_start AND PERFORMED_DT_TM < :part_end',{**params,'part_start':a,'part_end':b})
+      for a,b in zip(bounds[:-1],bounds[1:])]
+    parts+=[(f'SELECT * FROM ({sql}) WHERE PERFORMED_DT_TM >= :part_start',{**params,'part_start':bounds[-1]})]
+  else:
+    raise ValueError(f'unknown partitioning {by!r}, expected encounter or time')
+  return(parts)
+
+def query_partitions(parts: list[tuple[str,dict]], max_workers: int=MAX_WORKERS)->pd.DataFrame:
+  """Returns merged results of the partition queries, run concurrently on pooled connections at most max_workers at a time"""
+  def run(i,sql,params):
+    start=time.perf_counter()
+    df=query_oracle(sql,params)
+    timing={'partition':i,'rows':len(df),'seconds':round(time.perf_counter()-start,3)}
+    logger.info('partition %(partition)s: %(rows)s rows in %(seconds)ss',timing)
+    return(df,timing)
+  with ThreadPoolExecutor(max_workers=max_workers) as pool:
+    results=list(pool.map(run,range(len(parts)),*zip(*parts)))
+  df=pd.concat([r[0] for r in results],ignore_index=True)
+  df=df.sort_values(by=[c for c in MERGE_ORDER if c in df.columns],kind='stable',na_position='last',ignore_index=True)
+  df.attrs['partition_timings']=[r[1] for r in results]
+  return(df)
+
+def _main_sql(since: datetime=None)->tuple[str,dict]:
+  """Returns sql and params of the main query, only results performed at or after since if given"""
+  backend=backends.get_backend()
+  if since is None:
+    return(backend.sql_for('build_query',build_query),{})
+  else:
+    return(backend.sql_for('build_incremental_query',build_incremental_query),{'since':since})
+
+def main_chunks(since: datetime=None, arraysize: int=ARRAYSIZE)->Iterator[pd.DataFrame]:
+  """Builds and submits sql query, yielding results in chunks, only results performed at or after since if given"""
+  sql,params=_main_sql(since)
+  return(query_oracle_chunks(sql,params,arraysize))
+
+def main(since: datetime=None, partitions: int=1, partition_by: str='encounter', bounds: list=None, max_workers: int=MAX_WORKERS)->pd.DataFrame:
+  """Builds, submits, and returns results of sql query, only results performed at or after since if given
+
+  With partitions>1 the query is split by encounter id hash (or, with partition_by='time', at
+  bounds, which default to an even split of [since, now) and must be given for a query without since)
+  and the pieces run concurrently. Either way rows are ordered by encounter, performed time and accession.
+  """
+  if partitions>1 and partition_by=='time' and bounds is None:
+    if since is None:
+      raise ValueError("partition_by='time' without since needs bounds, e.g. at the performed times that split the history evenly")
+    bounds=time_bounds(since,datetime.now(),partitions)
+  sql,params=_main_sql(since)
+  with metrics.stage('query') as stage:
+    if partitions<=1:
+      df=pd.concat(query_oracle_chunks(sql,params),ignore_index=True)
+      df=df.sort_values(by=[c for c in MERGE_ORDER if c in df.columns],kind='stable',na_position='last',ignore_index=True)
+    else:
+      df=query_partitions(partition_query(sql,params,partitions,partition_by,bounds),max_workers)
+    stage['rows']=len(df)
+  return(df)
+
+def main_range(start: datetime, end: datetime)->pd.DataFrame:
+  """Returns cr results performed in [start, end), ordered by encounter, performed time and accession"""
+  sql=backends.get_backend().sql_for('build_range_query',build_range_query)
+  with metrics.stage('query_range') as stage:
+    df=pd.concat(query_oracle_chunks(sql,{'start':start,'end':end}),ignore_index=True)
+    df=df.sort_values(by=[c for c in MERGE_ORDER if c in df.columns],kind='stable',na_position='last',ignore_index=True)
+    stage['rows']=len(df)
+  return(df)
+
+def main_outpatient(since: datetime)->pd.DataFrame:
+  """Returns outpatient cr results performed after since, for outpatient_store.update"""
+  sql=backends.get_backend().sql_for('build_outpatient_query',build_outpatient_query)
+  with metrics.stage('query_outpatient') as stage:
+    df=query_oracle(sql,{'since':since})
+    stage['rows']=len(df)
+  return(df)
+
+def main_encounters(encntr_ids: list, batch_size: int=500)->pd.DataFrame:
+  """Returns all cr results of these encounters, ordered by encounter, performed time and accession"""
+  sql=backends.get_backend().sql_for('build_history_query',build_history_query)
+  ids=[float(e) for e in encntr_ids]
+  with metrics.stage('query_encounters',len(ids)) as stage:
+    frames=[]
+    for i in range(0,max(len(ids),1),batch_size): # bind variables per batch, below oracle's 1000 item IN list limit
+      params={f'e{j}':e for j,e in enumerate(ids[i:i+batch_size])} or {'e0':None}
+      frames.append(query_oracle(f'SELECT * FROM ({sql}) WHERE ENCNTR_ID IN ({",".join(":"+k for k in params)})',params))
+    df=pd.concat(frames,ignore_index=True)
+    df=df.sort_values(by=[c for c in MERGE_ORDER if c in df.columns],kind='stable',na_position='last',ignore_index=True)
+    stage['rows']=len(df)
   return(df)
 
 if __name__=='__main__':
-  df=main()
-  df.to_csv('%s.csv'%(datetime.today()- timedelta(days=1)).strftime('%Y-%m-%d'))
\ No newline at end of file
+  import snapshots
+  snapshots.write_snapshot_chunks(main_chunks(),'raw',(datetime.today()- timedelta(days=1)).date())
\ No newline at end of file
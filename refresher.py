@@ -0,0 +1,143 @@
+'''
+refresher.py
+
+Purpose: Background refresh of the analyzed data behind aki-dash.py, swapping each new snapshot in atomically
+
+Classes:
+
+  DataSnapshot(version, refreshed_at, df, index): One consistent version of the analyzed data and its row index
+  Refresher(load: Callable[[], pd.DataFrame], interval_minutes: float=REFRESH_MINUTES): Rebuilds the snapshot from load() on a schedule, keeping it when load() returns None
+  SnapshotCache(maxsize: int=CACHE_SIZE): Bounded LRU of values derived from one data version
+
+'''
+
+#%% imports
+import os
+import logging
+import threading
+from collections import OrderedDict
+import pandas as pd
+import encounter_index
+import metrics
+from datetime import datetime
+from typing import Any, Callable, Hashable, NamedTuple
+
+REFRESH_MINUTES=float(os.environ.get('AKI_REFRESH_MINUTES',240)) # 0 disables scheduled refresh
+CACHE_SIZE=int(os.environ.get('AKI_CACHE_SIZE',64))
+
+logger=logging.getLogger(__name__)
+
+#%% classes
+class DataSnapshot(NamedTuple):
+  version: int
+  refreshed_at: datetime
+  df: pd.DataFrame
+  index: encounter_index.EncounterIndex
+
+class Refresher:
+  '''Rebuilds the snapshot from load() on a schedule
+
+  Callbacks should call current() once and use that snapshot throughout; a refresh builds the
+  next snapshot off to the side and replaces the reference in a single assignment, so readers
+  never see a half built frame.
+  '''
+
+  def __init__(self, load: Callable[[], pd.DataFrame], interval_minutes: float=REFRESH_MINUTES):
+    self.load=load
+    self.interval_minutes=interval_minutes
+    self.listeners=[] # called with each new snapshot after it is swapped in
+    self._snapshot=None
+    self._refresh_lock=threading.Lock() # one refresh at a time
+    self._publish_lock=threading.Lock()
+    self._stop=threading.Event()
+    self._thread=None
+
+  def current(self)->DataSnapshot:
+    '''Returns the latest snapshot'''
+    return(self._snapshot)
+
+  def publish(self, df: pd.DataFrame, refreshed_at: datetime=None)->DataSnapshot:
+    '''Indexes df and swaps it in as the next snapshot'''
+    with metrics.stage('build_index',len(df)):
+      index=encounter_index.build_index(df)
+    with self._publish_lock:
+      previous=self._snapshot
+      snapshot=DataSnapshot(
+        version=(previous.version+1) if previous else 1,
+        refreshed_at=refreshed_at or datetime.now(),
+        df=df,
+        index=index)
+      self._snapshot=snapshot
+      for listener in self.listeners:
+        listener(snapshot)
+    return(snapshot)
+
+  def refresh(self)->DataSnapshot:
+    '''Loads, indexes and swaps in a new snapshot
+
+    load() may return None to keep the current snapshot (see shared_data.SharedLoader), and may
+    set df.attrs['refreshed_at'] when the data is older than this call.
+    '''
+    with self._refresh_lock, metrics.stage('refresh') as stage:
+      started=datetime.now()
+      df=self.load()
+      if df is None:
+        stage['rows']=0
+        return(self._snapshot)
+      snapshot=self.publish(df,df.attrs.get('refreshed_at',started))
+      stage['rows']=len(snapshot.df)
+      logger.info('data version %s loaded in %s',snapshot.version,datetime.now()-started)
+      return(snapshot)
+
+  def _try_refresh(self):
+    try:
+      self.refresh()
+    except Exception:
+      logger.exception('refresh failed, still serving version %s',self._snapshot.version if self._snapshot else None)
+
+  def _run(self, refresh_now: bool):
+    if refresh_now:
+      self._try_refresh()
+    while self.interval_minutes>0 and not self._stop.wait(self.interval_minutes*60):
+      self._try_refresh()
+
+  def start(self, refresh_now: bool=False):
+    '''Starts the background refresh thread: one refresh right away if refresh_now, then every interval if set'''
+    if (self.interval_minutes>0 or refresh_now) and self._thread is None:
+      self._thread=threading.Thread(target=self._run,args=(refresh_now,),name='aki-refresher',daemon=True)
+      self._thread.start()
+
+  def stop(self):
+    '''Stops the scheduled refresh thread'''
+    self._stop.set()
+
+class SnapshotCache:
+  '''Bounded LRU of values derived from one data version
+
+  Entries are keyed by (version, key), so a value built from an old snapshot is never returned
+  for a newer one; clear() is meant to be registered as a Refresher listener to free them early.
+  '''
+
+  def __init__(self, maxsize: int=CACHE_SIZE):
+    self.maxsize=maxsize
+    self._entries=OrderedDict()
+    self._lock=threading.Lock()
+
+  def get(self, snapshot: DataSnapshot, key: Hashable, build: Callable[[DataSnapshot], Any])->Any:
+    '''Returns cached value for key in this snapshot, calling build(snapshot) on a miss'''
+    cache_key=(snapshot.version,key)
+    with self._lock:
+      if cache_key in self._entries:
+        self._entries.move_to_end(cache_key)
+        return(self._entries[cache_key])
+    value=build(snapshot) # outside the lock so other keys are not held up
+    with self._lock:
+      self._entries[cache_key]=value
+      while len(self._entries)>self.maxsize:
+        self._entries.popitem(last=False)
+    return(value)
+
+  def clear(self, snapshot: DataSnapshot=None):
+    '''Drops all entries, e.g. when a new snapshot is swapped in'''
+    with self._lock:
+      self._entries.clear()
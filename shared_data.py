@@ -0,0 +1,162 @@
+'''
+shared_data.py
+
+Purpose: One copy of the analyzed data for every dashboard worker process
+
+One worker at a time holds the publisher lock. It runs the LIS query and analytics on the refresh schedule and writes
+the result as an uncompressed Arrow IPC file, sorted for encounter_index, next to a version stamp. Every worker, the
+publisher included, memory maps the latest file read-only and wraps its text columns in pyarrow backed
+columns without copying, so the page cache holds the data once however many workers there are. If the publisher exits its lock is
+released and the next worker to check takes over.
+
+Classes:
+
+  SharedLoader(load: Callable[[], pd.DataFrame], root: str=SHARED_ROOT, refresh_minutes: float=REFRESH_MINUTES): Load function for refresher.Refresher that publishes or maps the shared dataset
+
+Functions:
+
+  read_stamp(root: str=SHARED_ROOT)->Stamp: Returns the latest published version, else None
+  write_dataset(df: pd.DataFrame, root: str=SHARED_ROOT, refreshed_at: datetime=None)->Stamp: Publishes df as the next version
+  map_dataset(stamp: Stamp, root: str=SHARED_ROOT)->pd.DataFrame: Returns a published version as a read-only frame over the memory mapped file
+  try_lock(root: str=SHARED_ROOT)->IO: Returns the open lock file if this process took the publisher lock, else None
+
+'''
+
+#%% imports
+import os
+import json
+import glob
+import logging
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import encounter_index
+import metrics
+from datetime import datetime, timedelta
+from typing import IO, Callable, NamedTuple
+
+try:
+  import fcntl # not on windows
+except ImportError:
+  fcntl=None
+
+SHARED_ROOT=os.environ.get('AKI_SHARED_DATA') # directory shared by the workers, unset keeps the data in each process
+REFRESH_MINUTES=float(os.environ.get('AKI_REFRESH_MINUTES',240))
+CHECK_SECONDS=30 # how often workers look for a new version
+STAMP='VERSION.json'
+
+logger=logging.getLogger(__name__)
+
+class Stamp(NamedTuple):
+  version: int
+  refreshed_at: datetime
+
+#%% helper functions
+def _data_path(root: str, version: int)->str:
+  return(os.path.join(root,f'data-{version:06d}.arrow'))
+
+def read_stamp(root: str=SHARED_ROOT)->Stamp:
+  '''Returns the latest published version, else None'''
+  try:
+    with open(os.path.join(root,STAMP)) as f:
+      stamp=json.load(f)
+  except FileNotFoundError:
+    return(None)
+  return(Stamp(stamp['version'],datetime.fromisoformat(stamp['refreshed_at'])))
+
+def write_dataset(df: pd.DataFrame, root: str=SHARED_ROOT, refreshed_at: datetime=None)->Stamp:
+  '''Publishes df as the next version
+
+  The data file is complete before the stamp names it and both are moved into place, so readers
+  never map a partial file. Versions older than the previous one are removed; on windows a file
+  still mapped by a worker is left for the next publish.
+  '''
+  os.makedirs(root,exist_ok=True)
+  previous=read_stamp(root)
+  stamp=Stamp((previous.version+1) if previous else 1,refreshed_at or datetime.now())
+  with metrics.stage('shared_write',len(df)):
+    frame=df.sort_values(by=encounter_index.INDEX_KEYS,kind='stable',na_position='last',ignore_index=True)
+    table=pa.Table.from_pandas(frame,preserve_index=False)
+    path=_data_path(root,stamp.version)
+    with pa.OSFile(path+'.tmp','wb') as sink, ipc.new_file(sink,table.schema) as writer:
+      writer.write_table(table)
+    os.replace(path+'.tmp',path)
+    with open(os.path.join(root,STAMP+'.tmp'),'w') as f:
+      json.dump({'version':stamp.version,'refreshed_at':stamp.refreshed_at.isoformat(),'rows':len(df)},f)
+    os.replace(os.path.join(root,STAMP+'.tmp'),os.path.join(root,STAMP))
+  for old in glob.glob(os.path.join(root,'data-*.arrow')):
+    if old<_data_path(root,stamp.version-1):
+      try:
+        os.remove(old)
+      except OSError:
+        pass
+  return(stamp)
+
+def _column_type(arrow_type: pa.DataType):
+  '''Maps text columns to pyarrow backed dtypes, which wrap the mapped buffers
+
+  Dictionaries stay categorical, and timestamps, numbers and flags stay numpy, copying only codes
+  and 8 byte values, so missing values are nan rather than pd.NA and strftime, np.isnan and the
+  category based filters behave exactly as on an in-process frame.
+  '''
+  if pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type):
+    return(pd.ArrowDtype(arrow_type))
+  return(None)
+
+def map_dataset(stamp: Stamp, root: str=SHARED_ROOT)->pd.DataFrame:
+  '''Returns a published version as a read-only frame over the memory mapped file'''
+  with metrics.stage('shared_map') as stage:
+    table=ipc.open_file(pa.memory_map(_data_path(root,stamp.version),'r')).read_all()
+    df=table.to_pandas(types_mapper=_column_type)
+    df.attrs['sorted_by']=encounter_index.INDEX_KEYS # written sorted, see encounter_index.build_index
+    stage['rows']=len(df)
+  return(df)
+
+def try_lock(root: str=SHARED_ROOT)->IO:
+  '''Returns the open lock file if this process took the publisher lock, else None; held until the file is closed or the process exits'''
+  os.makedirs(root,exist_ok=True)
+  f=open(os.path.join(root,'publisher.lock'),'a')
+  if fcntl is None:
+    return(f) # no flock: run a single worker process
+  try:
+    fcntl.flock(f,fcntl.LOCK_EX|fcntl.LOCK_NB)
+  except OSError:
+    f.close()
+    return(None)
+  return(f)
+
+#%% classes
+class SharedLoader:
+  '''Load function for refresher.Refresher that publishes or maps the shared dataset
+
+  Each call takes the publisher lock if it is free, and as publisher runs load() and writes a new
+  version once the latest is refresh_minutes old. It then returns the latest version mapped from
+  disk, or None if this worker already has it, so the Refresher only swaps in changed data.
+  The first call maps an existing version rather than waiting for a refresh.
+  '''
+
+  def __init__(self, load: Callable[[], pd.DataFrame], root: str=SHARED_ROOT, refresh_minutes: float=REFRESH_MINUTES):
+    self.load=load
+    self.root=root
+    self.refresh_minutes=refresh_minutes
+    self.version=None # version this worker has mapped
+    self._lock=None
+
+  def __call__(self)->pd.DataFrame:
+    stamp=read_stamp(self.root)
+    if self._lock is None:
+      self._lock=try_lock(self.root)
+      if self._lock is not None:
+        logger.info('worker %s publishes the shared dataset',os.getpid())
+    stale=stamp is None or (self.version is not None and self.refresh_minutes>0
+      and datetime.now()-stamp.refreshed_at>=timedelta(minutes=self.refresh_minutes))
+    if self._lock is not None and stale:
+      started=datetime.now()
+      stamp=write_dataset(self.load(),self.root,started)
+      logger.info('published shared version %s',stamp.version)
+    if stamp is None or stamp.version==self.version:
+      return(None)
+    df=map_dataset(stamp,self.root)
+    df.attrs['refreshed_at']=stamp.refreshed_at
+    self.version=stamp.version
+    return(df)
@@ -0,0 +1,84 @@
+'''
+snapshots.py
+
+Purpose: Typed columnar (parquet) snapshots of query and analytics output, partitioned by date
+
+Layout:
+
+  <root>/<kind>/date=YYYY-MM-DD/part-NNNNN.parquet, where kind is e.g. 'raw' for query output or 'analyzed' for analytics output
+
+Functions:
+
+  partition_dir(kind: str, day: date, root: str=SNAPSHOT_ROOT)->str: Returns directory holding the parquet parts for this kind and day
+  write_snapshot_chunks(chunks: Iterable[pd.DataFrame], kind: str, day: date=None, root: str=SNAPSHOT_ROOT)->str: Writes each chunk as a part of the partition for day (default today), returns its directory
+  write_snapshot(df: pd.DataFrame, kind: str, day: date=None, root: str=SNAPSHOT_ROOT)->str: Writes df as the partition for day (default today), returns its directory
+  list_partitions(kind: str, root: str=SNAPSHOT_ROOT)->list[date]: Returns dates with a snapshot, oldest first
+  read_snapshot(kind: str, start: date=None, end: date=None, columns: list=None, root: str=SNAPSHOT_ROOT)->pd.DataFrame: Returns partitions between start and end inclusive, only the requested columns
+  read_latest(kind: str, columns: list=None, root: str=SNAPSHOT_ROOT)->tuple[pd.DataFrame,datetime]: Returns the newest partition and when it was written, else (None, None)
+
+'''
+
+#%% imports
+import os
+import glob
+import shutil
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datetime import date,datetime
+from typing import Iterable
+
+SNAPSHOT_ROOT=os.environ.get('AKI_SNAPSHOT_ROOT','snapshots')
+
+#%% helper functions
+def partition_dir(kind: str, day: date, root: str=SNAPSHOT_ROOT)->str:
+  '''Returns directory holding the parquet parts for this kind and day'''
+  return(os.path.join(root,kind,f'date={day.isoformat()}'))
+
+def _parts(path: str)->list[str]:
+  return(sorted(glob.glob(os.path.join(path,'part-*.parquet'))))
+
+def write_snapshot_chunks(chunks: Iterable[pd.DataFrame], kind: str, day: date=None, root: str=SNAPSHOT_ROOT)->str:
+  '''Writes each chunk as a part of the partition for day (default today), returns its directory'''
+  path=partition_dir(kind,day or date.today(),root)
+  tmp,old=path+'.tmp',path+'.old'
+  shutil.rmtree(tmp,ignore_errors=True)
+  os.makedirs(tmp)
+  for i,chunk in enumerate(chunks):
+    table=pa.Table.from_pandas(chunk,preserve_index=False) # keeps datetime64 and categorical (dictionary) types
+    pq.write_table(table,os.path.join(tmp,'part-%05d.parquet'%i),compression='zstd')
+  shutil.rmtree(old,ignore_errors=True)
+  if os.path.exists(path):
+    os.rename(path,old)
+  os.rename(tmp,path) # readers never see a half written partition
+  shutil.rmtree(old,ignore_errors=True)
+  return(path)
+
+def write_snapshot(df: pd.DataFrame, kind: str, day: date=None, root: str=SNAPSHOT_ROOT)->str:
+  '''Writes df as the partition for day (default today), returns its directory'''
+  return(write_snapshot_chunks([df],kind,day,root))
+
+def list_partitions(kind: str, root: str=SNAPSHOT_ROOT)->list[date]:
+  '''Returns dates with a snapshot, oldest first'''
+  kind_dir=os.path.join(root,kind)
+  if not os.path.isdir(kind_dir):
+    return([])
+  days=[date.fromisoformat(d[len('date='):]) for d in os.listdir(kind_dir)
+    if d.startswith('date=') and '.' not in d and _parts(os.path.join(kind_dir,d))]
+  return(sorted(days))
+
+def read_snapshot(kind: str, start: date=None, end: date=None, columns: list=None, root: str=SNAPSHOT_ROOT)->pd.DataFrame:
+  '''Returns partitions between start and end inclusive, only the requested columns'''
+  days=[d for d in list_partitions(kind,root) if (start is None or d>=start) and (end is None or d<=end)]
+  tables=[pq.read_table(part,columns=columns,memory_map=True) for d in days for part in _parts(partition_dir(kind,d,root))]
+  if not tables:
+    return(pd.DataFrame(columns=columns))
+  return(pa.concat_tables(tables,promote_options='permissive').to_pandas()) # e.g. categorical codes widen as a column gains values
+
+def read_latest(kind: str, columns: list=None, root: str=SNAPSHOT_ROOT)->tuple[pd.DataFrame,datetime]:
+  '''Returns the newest partition and when it was written, else (None, None)'''
+  days=list_partitions(kind,root)
+  if not days:
+    return(None,None)
+  written_at=datetime.fromtimestamp(os.path.getmtime(partition_dir(kind,days[-1],root)))
+  return(read_snapshot(kind,days[-1],days[-1],columns,root),written_at)
@@ -0,0 +1,174 @@
+'''
+state_store.py
+
+Purpose: Local SQLite store of per-encounter baseline state so analytics can stage only new Cr results each day
+
+Tables:
+
+  encounters: one row per open encounter - first cr seen, running minimum cr, last performed time
+  window: recent results per encounter that can still fall inside a future two day baseline window (WINDOW_HOURS)
+  samples: staged samples for open encounters, as returned by analytics; their accessions mark results already staged
+  meta: key/value pairs, e.g. the performed time high-water mark and the window the store was built with
+
+Functions:
+
+  connect(path: str=STATE_DB)->sqlite3.Connection: Returns connection to the state store, creating tables if needed
+  get_meta(conn, key: str)->str: Returns stored value for key, else None
+  set_meta(conn, key: str, value: str, commit: bool=True): Stores value for key
+  known_encounters(conn, encntr_ids: list)->set: Returns those of these encounters that have stored state
+  load_carry_rows(conn, encntr_ids: list)->pd.DataFrame: Returns stored rows that stand in for earlier results of these encounters
+  save_state(conn, df: pd.DataFrame, window_hours: float=WINDOW_HOURS, commit: bool=True): Updates encounter state with newly staged results
+  append_samples(conn, df: pd.DataFrame): Appends staged samples
+  load_samples(conn)->pd.DataFrame: Returns all staged samples for open encounters
+  staged_accessions(conn, accessions: list)->set: Returns those of these accessions already staged
+  evict(conn, before: datetime)->int: Removes encounters idle since before, returns number removed
+
+'''
+
+#%% imports
+import os
+import sqlite3
+import pandas as pd
+import numpy as np
+from datetime import datetime
+
+STATE_DB='aki_state.sqlite'
+WINDOW_HOURS=float(os.environ.get('AKI_TWODAY_HOURS',48)) # two day baseline window, the default for analytics and every staging path
+SENTINEL_DT_TM=pd.Timestamp('1900-01-01') # carried summary rows sit outside every two day window
+SAMPLE_DATE_COLS=['DRAWN_DT_TM','RECEIVED_DT_TM','PERFORMED_DT_TM']
+
+#%% helper functions
+def connect(path: str=STATE_DB)->sqlite3.Connection:
+  '''Returns connection to the state store, creating tables if needed'''
+  conn=sqlite3.connect(path)
+  conn.executescript('''
+    CREATE TABLE IF NOT EXISTS encounters (
+      ENCNTR_ID REAL PRIMARY KEY,
+      first_cr REAL,
+      min_cr REAL,
+      last_dt_tm INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS window (
+      seq INTEGER PRIMARY KEY AUTOINCREMENT,
+      ENCNTR_ID REAL,
+      PERFORMED_DT_TM INTEGER,
+      RESULT_VAL REAL
+    );
+    CREATE INDEX IF NOT EXISTS window_encntr ON window (ENCNTR_ID);
+    CREATE TABLE IF NOT EXISTS meta (
+      key TEXT PRIMARY KEY,
+      value TEXT
+    );
+  ''')
+  return(conn)
+
+def get_meta(conn: sqlite3.Connection, key: str)->str:
+  '''Returns stored value for key, else None'''
+  row=conn.execute('SELECT value FROM meta WHERE key=?',(key,)).fetchone()
+  return(row[0] if row else None)
+
+def set_meta(conn: sqlite3.Connection, key: str, value: str, commit: bool=True):
+  '''Stores value for key'''
+  conn.execute('INSERT OR REPLACE INTO meta (key,value) VALUES (?,?)',(key,value))
+  if commit:
+    conn.commit()
+
+def _to_ns(times: pd.Series)->list:
+  return(pd.to_datetime(times).to_numpy(dtype='datetime64[ns]').view('i8').tolist())
+
+def _nullable(vals)->list:
+  return([None if v!=v else float(v) for v in vals])
+
+def _select_in(conn: sqlite3.Connection, sql: str, ids: list)->list:
+  '''Returns rows of sql run over ids in batches below the sqlite variable limit'''
+  rows=[]
+  for i in range(0,len(ids),500):
+    batch=ids[i:i+500]
+    rows+=conn.execute(sql%','.join('?'*len(batch)),batch).fetchall()
+  return(rows)
+
+def known_encounters(conn: sqlite3.Connection, encntr_ids: list)->set:
+  '''Returns those of these encounters that have stored state'''
+  return({r[0] for r in _select_in(conn,'SELECT ENCNTR_ID FROM encounters WHERE ENCNTR_ID IN (%s)',[float(x) for x in encntr_ids])})
+
+def load_carry_rows(conn: sqlite3.Connection, encntr_ids: list)->pd.DataFrame:
+  '''Returns stored rows that stand in for earlier results of these encounters
+
+  For each encounter: the first result seen and the running minimum, both stamped with
+  SENTINEL_DT_TM so they count toward the encounter baseline but never toward the two day
+  baseline, followed by the retained window rows in their original order. Placing these ahead
+  of new results reproduces the baselines that a run over the full history would give.
+  '''
+  ids=[float(x) for x in encntr_ids]
+  summary=_select_in(conn,'SELECT ENCNTR_ID,first_cr,min_cr FROM encounters WHERE ENCNTR_ID IN (%s)',ids)
+  window=_select_in(conn,'SELECT ENCNTR_ID,PERFORMED_DT_TM,RESULT_VAL,seq FROM window WHERE ENCNTR_ID IN (%s)',ids)
+  first=pd.DataFrame([(e,SENTINEL_DT_TM,f,0) for e,f,m in summary],columns=['ENCNTR_ID','PERFORMED_DT_TM','RESULT_VAL','seq'])
+  running=pd.DataFrame([(e,SENTINEL_DT_TM,m,1) for e,f,m in summary],columns=first.columns)
+  recent=pd.DataFrame(window,columns=first.columns)
+  recent['PERFORMED_DT_TM']=pd.to_datetime(recent['PERFORMED_DT_TM'].astype('int64'))
+  recent['seq']=recent['seq']+1
+  carry=pd.concat([first,running,recent],ignore_index=True).sort_values(by='seq',kind='stable')
+  return(carry.drop(columns='seq').astype({'RESULT_VAL':float}).reset_index(drop=True))
+
+def save_state(conn: sqlite3.Connection, df: pd.DataFrame, window_hours: float=WINDOW_HOURS, commit: bool=True):
+  '''Updates encounter state with newly staged results, given in frame order; with commit=False the caller commits, e.g. together with a checkpoint'''
+  df=df.loc[df['ENCNTR_ID'].notna()&df['PERFORMED_DT_TM'].notna(),['ENCNTR_ID','PERFORMED_DT_TM','RESULT_VAL']]
+  if len(df)==0:
+    return
+  df=df.assign(ENCNTR_ID=df['ENCNTR_ID'].astype(float),RESULT_VAL=pd.to_numeric(df['RESULT_VAL'],errors='coerce').astype(float))
+  by_encntr=df.groupby('ENCNTR_ID',sort=False)
+  new=pd.DataFrame({'first_cr':df.drop_duplicates(subset='ENCNTR_ID').set_index('ENCNTR_ID')['RESULT_VAL'],
+    'min_cr':by_encntr['RESULT_VAL'].min()}) # min skips nan like the baseline engines
+  last_dt_tm=by_encntr['PERFORMED_DT_TM'].max()
+  new_last=pd.Series(_to_ns(last_dt_tm),index=last_dt_tm.index)
+  old=pd.DataFrame(_select_in(conn,'SELECT ENCNTR_ID,first_cr,min_cr,last_dt_tm FROM encounters WHERE ENCNTR_ID IN (%s)',new.index.tolist()),
+    columns=['ENCNTR_ID','first_cr','min_cr','last_dt_tm']).set_index('ENCNTR_ID')
+  seen=new.index.isin(old.index)
+  old=old.reindex(new.index)
+  new['first_cr']=np.where(seen,old['first_cr'].astype(float),new['first_cr']) # an earlier run saw these encounters first
+  new['min_cr']=np.fmin(new['min_cr'],old['min_cr'].astype(float))
+  last=[max(n,int(o)) if s else n for n,o,s in zip(new_last.reindex(new.index).tolist(),old['last_dt_tm'].tolist(),seen)]
+  conn.executemany('INSERT OR REPLACE INTO encounters (ENCNTR_ID,first_cr,min_cr,last_dt_tm) VALUES (?,?,?,?)',
+    zip(new.index.tolist(),_nullable(new['first_cr']),_nullable(new['min_cr']),last))
+  conn.executemany('INSERT INTO window (ENCNTR_ID,PERFORMED_DT_TM,RESULT_VAL) VALUES (?,?,?)',
+    zip(df['ENCNTR_ID'].tolist(),_to_ns(df['PERFORMED_DT_TM']),_nullable(df['RESULT_VAL'])))
+  width=int(window_hours*3600*10**9) # ns
+  conn.execute('''DELETE FROM window WHERE PERFORMED_DT_TM <= (
+    SELECT e.last_dt_tm - ? FROM encounters e WHERE e.ENCNTR_ID=window.ENCNTR_ID)''',(width,))
+  if commit:
+    conn.commit()
+
+def append_samples(conn: sqlite3.Connection, df: pd.DataFrame):
+  '''Appends staged samples'''
+  df=df.copy()
+  for col in df.columns:
+    if isinstance(df[col].dtype,pd.CategoricalDtype):
+      df[col]=df[col].astype(object)
+  df.to_sql('samples',conn,if_exists='append',index=False)
+  conn.commit()
+
+def load_samples(conn: sqlite3.Connection)->pd.DataFrame:
+  '''Returns all staged samples for open encounters'''
+  if not conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='samples'").fetchone():
+    return(pd.DataFrame())
+  return(pd.read_sql('SELECT * FROM samples',conn,parse_dates=SAMPLE_DATE_COLS))
+
+def staged_accessions(conn: sqlite3.Connection, accessions: list)->set:
+  '''Returns those of these accessions already staged'''
+  if not conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='samples'").fetchone():
+    return(set())
+  return({str(r[0]) for r in _select_in(conn,'SELECT ACCESSION FROM samples WHERE ACCESSION IN (%s)',[str(a) for a in accessions])})
+
+def evict(conn: sqlite3.Connection, before: datetime)->int:
+  '''Removes encounters idle since before, returns number removed'''
+  ids=[r[0] for r in conn.execute('SELECT ENCNTR_ID FROM encounters WHERE last_dt_tm < ?',(_to_ns(pd.Series([before]))[0],))]
+  has_samples=conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='samples'").fetchone()
+  for i in range(0,len(ids),500):
+    batch=ids[i:i+500]
+    marks=','.join('?'*len(batch))
+    conn.execute('DELETE FROM encounters WHERE ENCNTR_ID IN (%s)'%marks,batch)
+    conn.execute('DELETE FROM window WHERE ENCNTR_ID IN (%s)'%marks,batch)
+    if has_samples:
+      conn.execute('DELETE FROM samples WHERE ENCNTR_ID IN (%s)'%marks,batch)
+  conn.commit()
+  return(len(ids))
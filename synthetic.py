@@ -0,0 +1,152 @@
+'''
+synthetic.py
+
+Purpose: Synthetic LIS Cr results with the same columns as queries.main(), for offline runs, benchmarks and capacity planning
+
+Functions:
+
+  make_lis_frame(n_rows: int, seed: int=0, end: datetime=END, days: float=30, draws_per_encounter: float=8, aki_rate: float=0.15, excluded_rate: float=0.01, missing_rate: float=0.01, new_rate: float=0.9)->pd.DataFrame: Returns about n_rows synthetic Cr results
+  make_outpatient_frame(lis: pd.DataFrame, per_patient: float=6, seed: int=0, days: float=365)->pd.DataFrame: Returns outpatient Cr results for the patients in lis that have an outpatient baseline
+
+Usage:
+
+  python synthetic.py 100000 --sqlite lis_fixture.sqlite  # writes a fixture for AKI_DB_BACKEND=sqlite, outpatient results included
+
+'''
+
+#%% imports
+import argparse
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+END=datetime(2022,11,1,6,0) # fixed so frames are reproducible from the seed alone
+LIS_COLS=['ENCNTR_ID','EPIC_MRN','NAME_FULL_FORMATTED','BIRTH_DT_TM','PATIENT_SEX','PATIENT_RACE','PT_AGE',
+  'ACCESSION','TASK_ASSAY','TUBE_TYPE','DRAWN_DT_TM','RECEIVED_DT_TM','PERFORMED_DT_TM','RESULT_VAL',
+  'OUTPATIENT_BASELINE','NEW_RESULT_IND']
+LAST_NAMES=['SMITH','JOHNSON','WILLIAMS','BROWN','JONES','GARCIA','MILLER','DAVIS','WILSON','TAYLOR','MOORE','JACKSON','WHITE','HARRIS','CLARK']
+FIRST_NAMES=['JAMES','MARY','ROBERT','PATRICIA','JOHN','JENNIFER','MICHAEL','LINDA','DAVID','ELIZABETH','WILLIAM','BARBARA']
+EXCLUDED_NAMES=['CAP, CHEM SURVEY','CAP C-A, SURVEY','TESTPATIENT, LAB','IOH, TEST'] # dropped by analytics.clean_data
+RACES=['Black','White','Asian','Other',None] # labels as the LIS returns them, see analytics.encode_race
+RACE_P=[0.3,0.55,0.05,0.05,0.05]
+TUBE_TYPES=['Green','Gold','Lavender']
+
+#%% helper functions
+def make_lis_frame(n_rows: int, seed: int=0, end: datetime=END, days: float=30, draws_per_encounter: float=8,
+  aki_rate: float=0.15, excluded_rate: float=0.01, missing_rate: float=0.01, new_rate: float=0.9)->pd.DataFrame:
+  '''Returns about n_rows synthetic Cr results
+
+  Patients have one or more encounters spread over the days before end, each with repeated
+  draws around the patient's own baseline. Like the LIS query, which selects encounters with a new
+  result in the past 24 hours, a share of encounters (new_rate) has its last draw in the final 24
+  hours before end; the rest end earlier in the window. A share of encounters (aki_rate) has a rise
+  large enough to stage, some recovered by their last draw and some still rising or at peak, and
+  about half of patients have an outpatient baseline. CAP
+  and test patient rows, '<0.2' and missing results, and missing draw times and assays are mixed
+  in at the given rates so clean_data has its usual work to do.
+  '''
+  rng=np.random.default_rng(seed)
+  n_encounters=max(1,int(round(n_rows/draws_per_encounter)))
+  n_patients=max(1,int(n_encounters/1.3))
+
+  # patients
+  sex=rng.choice(['Female','Male'],n_patients)
+  age=rng.integers(18,95,n_patients).astype(float)
+  patient_base=np.exp(rng.normal(np.log(np.where(sex=='Female',0.8,1.0)),0.25)) # usual Cr, mg/dL
+  has_op=rng.random(n_patients)<0.5
+  op_baseline=np.where(has_op,np.round(patient_base*rng.normal(1,0.05,n_patients),2),np.nan)
+  op_baseline[has_op&(rng.random(n_patients)<0.02)]=0 # zero baselines are skipped by select_baselines
+  names=np.char.add(np.char.add(rng.choice(LAST_NAMES,n_patients).astype(str),', '),rng.choice(FIRST_NAMES,n_patients).astype(str))
+  excluded=rng.random(n_patients)<excluded_rate
+  names[excluded]=rng.choice(EXCLUDED_NAMES,excluded.sum())
+  birth=pd.Timestamp(end)-pd.to_timedelta(age*365.25+rng.uniform(0,365,n_patients),unit='D')
+
+  # encounters
+  patient=np.sort(rng.integers(0,n_patients,n_encounters))
+  encntr_id=(1e8+np.arange(n_encounters)*7+rng.integers(0,7,n_encounters)).astype(float)
+  draws=np.maximum(1,rng.geometric(1/draws_per_encounter,n_encounters))
+  scale=n_rows/draws.sum() # land close to n_rows
+  draws=np.maximum(1,np.round(draws*scale)).astype(int)
+  aki=rng.random(n_encounters)<aki_rate
+  peak=np.where(aki,rng.uniform(1.5,3.5,n_encounters),1.0)
+
+  # draws
+  enc=np.repeat(np.arange(n_encounters),draws)
+  n=len(enc)
+  first=np.repeat(np.cumsum(draws)-draws,draws)
+  step=np.arange(n)-first # draw number within encounter
+  gaps=rng.exponential(12,n) # hours
+  gaps[step==0]=0
+  hours=pd.Series(gaps).groupby(enc).cumsum().to_numpy()
+  span=np.repeat(pd.Series(hours).groupby(enc).max().to_numpy(),draws)
+  last_h=np.where(rng.random(n_encounters)<new_rate,rng.uniform(-24,-0.5,n_encounters),
+    rng.uniform(-days*24,-24,n_encounters)) # hours before end of each encounter's last draw
+  performed_h=np.repeat(last_h,draws)-span+hours
+  phase=np.where(span>0,hours/np.maximum(span,1),0)
+  pace=np.repeat(rng.uniform(0.5,1.4,n_encounters),draws) # below 1 the encounter's last draw is before recovery
+  bump=1+(np.repeat(peak,draws)-1)*np.sin(np.pi*np.clip(phase*pace,0,1)) # rise then recovery
+  value=np.repeat(patient_base[patient],draws)*bump*rng.normal(1,0.04,n)
+  result=np.char.mod('%.2f',np.round(value,2)).astype(object)
+  result[value<0.2]='<0.2'
+  result[rng.random(n)<missing_rate]=None
+
+  performed=pd.Timestamp(end)+pd.to_timedelta(performed_h,unit='h')
+  received=performed-pd.to_timedelta(rng.uniform(15,90,n),unit='m')
+  drawn=received-pd.to_timedelta(rng.uniform(5,120,n),unit='m')
+  pt=patient[enc]
+  df=pd.DataFrame({
+    'ENCNTR_ID':encntr_id[enc],
+    'EPIC_MRN':np.char.mod('%09d',5000000+pt).astype(object),
+    'NAME_FULL_FORMATTED':names[pt].astype(object),
+    'BIRTH_DT_TM':birth[pt].normalize(),
+    'PATIENT_SEX':sex[pt].astype(object),
+    'PATIENT_RACE':np.array(RACES,dtype=object)[rng.choice(len(RACES),n_patients,p=RACE_P)][pt],
+    'PT_AGE':age[pt],
+    'ACCESSION':np.char.mod('0000022%09d',rng.permutation(n)).astype(object),
+    'TASK_ASSAY':'Creatinine',
+    'TUBE_TYPE':rng.choice(TUBE_TYPES,n,p=[0.8,0.15,0.05]).astype(object),
+    'DRAWN_DT_TM':drawn.floor('s'),
+    'RECEIVED_DT_TM':received.floor('s'),
+    'PERFORMED_DT_TM':performed.floor('s'),
+    'RESULT_VAL':result,
+    'OUTPATIENT_BASELINE':op_baseline[pt],
+    'NEW_RESULT_IND':(performed_h>-24).astype(int),
+  })
+  df.loc[rng.random(n)<missing_rate/2,'DRAWN_DT_TM']=pd.NaT
+  df.loc[rng.random(n)<missing_rate/2,'TASK_ASSAY']=None
+  df.loc[rng.random(n)<missing_rate,'PT_AGE']=np.nan
+  return(df[LIS_COLS].sort_values(by=['ENCNTR_ID','PERFORMED_DT_TM'],kind='stable',ignore_index=True))
+
+def make_outpatient_frame(lis: pd.DataFrame, per_patient: float=6, seed: int=0, days: float=365)->pd.DataFrame:
+  '''Returns outpatient Cr results (outpatient_store.py columns) scattered over the year before each patient's first result in lis
+
+  Patients with an OUTPATIENT_BASELINE get results around it, so a local median reproduces it closely.
+  '''
+  rng=np.random.default_rng(seed)
+  patients=lis.loc[lis['OUTPATIENT_BASELINE'].fillna(0)>0].groupby('EPIC_MRN')[['OUTPATIENT_BASELINE','PERFORMED_DT_TM']].agg({'OUTPATIENT_BASELINE':'first','PERFORMED_DT_TM':'min'})
+  counts=np.maximum(1,rng.poisson(per_patient,len(patients)))
+  mrn=np.repeat(patients.index.to_numpy(),counts)
+  first=np.repeat(pd.to_datetime(patients['PERFORMED_DT_TM']).to_numpy(),counts)
+  value=np.repeat(patients['OUTPATIENT_BASELINE'].to_numpy(),counts)*rng.normal(1,0.05,len(mrn))
+  return(pd.DataFrame({
+    'ACCESSION':np.char.mod('0000011%09d',rng.permutation(len(mrn))).astype(object),
+    'EPIC_MRN':mrn,
+    'PERFORMED_DT_TM':(pd.to_datetime(first)-pd.to_timedelta(rng.uniform(1,days,len(mrn)),unit='D')).floor('s'),
+    'RESULT_VAL':np.char.mod('%.2f',np.round(value,2)).astype(object),
+  }))
+
+if __name__=='__main__':
+  import backends
+  parser=argparse.ArgumentParser(description='Write synthetic LIS Cr results')
+  parser.add_argument('n_rows',type=int)
+  parser.add_argument('--seed',type=int,default=0)
+  parser.add_argument('--sqlite',help='write as the cr_results table of a SQLite backend fixture')
+  parser.add_argument('--parquet',help='write as a parquet file')
+  args=parser.parse_args()
+  df=make_lis_frame(args.n_rows,args.seed)
+  if args.sqlite:
+    backends.load_fixture(df,args.sqlite)
+    backends.load_fixture(make_outpatient_frame(df,seed=args.seed),args.sqlite,backends.OUTPATIENT_TABLE)
+  if args.parquet:
+    df.to_parquet(args.parquet,index=False)
+  print(f'{len(df)} rows, {df.ENCNTR_ID.nunique()} encounters, {df.EPIC_MRN.nunique()} patients')